@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Benchmark of the overhead the UI adds on top of model inference.
+
+It runs the spec parsing of `launch.py` and `ui_utils.api_call` against a
+local stub DEEPaaS (see `stub_deepaas.py`), for several output shapes,
+payload sizes and concurrency levels, and reports latency percentiles,
+throughput and peak memory. It runs offline, so it can be used in CI to
+catch performance regressions (see `--baseline`).
+
+Each scenario is also run straight against the stub, and regressions are
+measured on the overhead of the UI relative to it (median latency with the UI
+/ without it), which depends much less on the machine than raw latencies.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+import click
+import httpx
+
+
+# Keep benchmark outputs apart from the outputs of a running UI
+os.environ['OUTPUT_DIR'] = tempfile.mkdtemp(prefix='deepaas_ui_benchmark_')
+
+import launch  # noqa: E402
+from metrics import percentile  # noqa: E402
+import stub_deepaas  # noqa: E402
+import ui_utils  # noqa: E402
+from workers import free_port  # noqa: E402
+
+
+# Slack (in ms) added to the latencies when comparing them, so tiny latencies do
+# not give noisy overheads
+SLACK_MS = 5
+
+# Output shapes: (MIME, value of the "output" param of the stub)
+SHAPES = {
+    'json': ('application/json', 'json'),
+    'media': ('application/json', 'media'),
+    'binary': ('image/png', 'media'),
+    }
+
+
+class MemorySampler:
+    """
+    Sample the resident memory of the process in a background thread, to
+    measure the peak memory of each scenario.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    @staticmethod
+    def rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            # Not in Linux: fallback to the peak memory of the whole process
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == 'darwin' else peak * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.peak = self.rss()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+
+def bench_parsing(specs, repeats=20):
+    """
+    Time (in ms) needed to turn the DEEPaaS spec into Gradio components.
+    """
+    p = f'{stub_deepaas.MODEL_PATH}/predict/'
+    start = time.perf_counter()
+    for _ in range(repeats):
+        api_inp = launch.parse_inputs(specs, p)
+        for mime in specs['paths'][p]['post']['produces']:
+            if mime != '*/*':
+                ui_utils.api2gr_inputs(api_inp)
+                ui_utils.RequestPlan(api_inp)
+                ui_utils.build_components(launch.parse_outputs(specs, mime)[0])
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+async def bench_calls(call, args, n_requests, concurrency):
+    """
+    Run `n_requests` predictions, `concurrency` at a time.
+    Return the latencies (in seconds), the total time and the number of errors.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def predict():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await call(*args)
+            except Exception as e:
+                errors += 1
+                print(f"Prediction failed: {e}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[predict() for _ in range(n_requests)])
+    total = time.perf_counter() - start
+    await ui_utils.close_client()  # the client is bound to this event loop
+    return latencies, total, errors
+
+
+def direct_call(url, mime, upload, params):
+    """
+    Same prediction as the UI, sent straight to the stub.
+    """
+    async def call():
+        with open(upload, 'rb') as f:
+            r = await ui_utils.get_client().post(
+                url,
+                headers={'accept': mime},
+                params={**params, 'accept': mime},
+                files={'data': f},
+                )
+        r.raise_for_status()
+    return call
+
+
+def compare(report, baseline, tolerance):
+    """
+    Return the scenarios whose overhead over the stub alone regressed compared
+    to the baseline.
+    """
+    old = {r['scenario']: r for r in baseline['scenarios']}
+    regressions = []
+    for r in report['scenarios']:
+        if 'overhead' not in old.get(r['scenario'], {}):
+            continue
+        limit = old[r['scenario']]['overhead'] * (1 + tolerance)
+        if r['overhead'] > limit:
+            regressions.append(f"{r['scenario']}: overhead x{r['overhead']:.2f} > x{limit:.2f}")
+    return regressions
+
+
+@click.command()
+@click.option('--shapes',
+              default='json,media,binary',
+              help='Output shapes to benchmark (json, media, binary)')
+@click.option('--sizes',
+              default='1024,1048576,8388608',
+              help='Output sizes (in bytes) to benchmark')
+@click.option('--concurrency',
+              default='1,8,32',
+              help='Concurrency levels to benchmark')
+@click.option('--requests', 'n_requests',
+              default=64,
+              help='Number of predictions per scenario')
+@click.option('--upload_size',
+              default=64 * 1024,
+              help='Size (in bytes) of the uploaded input file')
+@click.option('--output',
+              default=None,
+              help='Save the report to this JSON file')
+@click.option('--baseline',
+              default=None,
+              help='Fail if overheads over the stub alone regress compared to this JSON report')
+@click.option('--tolerance',
+              default=1.0,
+              help='Allowed relative overhead regression compared to the baseline')
+def main(shapes, sizes, concurrency, n_requests, upload_size, output, baseline, tolerance):
+    warnings.simplefilter('ignore')
+    port = free_port()
+    api_url = f'http://127.0.0.1:{port}'
+    stub = stub_deepaas.start(port)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        specs = httpx.get(f'{api_url}/swagger.json').json()
+        report = {
+            'parsing_ms': bench_parsing(specs),
+            'scenarios': [],
+            }
+        print(f"Spec parsing: {report['parsing_ms']:.1f}ms")
+
+        # Input file uploaded in every prediction
+        upload = os.path.join(tmpdir, 'input.png')
+        with open(upload, 'wb') as f:
+            f.write(os.urandom(upload_size))
+
+        p = f'{stub_deepaas.MODEL_PATH}/predict/'
+        api_inp = launch.parse_inputs(specs, p)
+
+        print(f"{'scenario':<28} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8} {'peak RSS':>9} {'overhead':>9}")
+        for shape in shapes.split(','):
+            mime, out = SHAPES[shape]
+            gr_out, schema = launch.parse_outputs(specs, mime)
+            gr_out = ui_utils.build_components(gr_out)
+            call = functools.partial(
+                ui_utils.api_call,
+                plan=ui_utils.RequestPlan(api_inp),
+                gr_out=gr_out,
+                url=api_url + p,
+                mime=mime,
+                schema=schema,
+                cache=False,
+                )
+            for size in [int(s) for s in sizes.split(',')]:
+                # Gradio inputs: file (+ info), size, latency, output, texts
+                args = [upload, None, size, 0, out, '']
+                for c in [int(c) for c in concurrency.split(',')]:
+                    # Measure the UI, not the admission control
+                    ui_utils.admission = ui_utils.AdmissionController(max_inflight=c, max_queue=c)
+                    with MemorySampler() as mem:
+                        latencies, total, errors = asyncio.run(bench_calls(call, args, n_requests, c))
+
+                    # Reference run without the UI, on the same machine
+                    direct, _, direct_errors = asyncio.run(bench_calls(
+                        direct_call(api_url + p, mime, upload, {'size': size, 'output': out}),
+                        [],
+                        n_requests,
+                        c,
+                        ))
+
+                    r = {
+                        'scenario': f'{shape}-{size}-c{c}',
+                        'p50_ms': percentile(latencies, 0.50) * 1000,
+                        'p95_ms': percentile(latencies, 0.95) * 1000,
+                        'p99_ms': percentile(latencies, 0.99) * 1000,
+                        'throughput': n_requests / total,
+                        'peak_rss_mb': mem.peak / 1024 ** 2,
+                        'direct_p50_ms': percentile(direct, 0.50) * 1000,
+                        'errors': errors + direct_errors,
+                        }
+                    r['overhead'] = (r['p50_ms'] + SLACK_MS) / (r['direct_p50_ms'] + SLACK_MS)
+                    report['scenarios'].append(r)
+                    print(
+                        f"{r['scenario']:<28} {r['p50_ms']:>7.1f}ms {r['p95_ms']:>7.1f}ms "
+                        f"{r['p99_ms']:>7.1f}ms {r['throughput']:>8.1f} {r['peak_rss_mb']:>7.0f}MB "
+                        f"{r['overhead']:>8.2f}x"
+                        )
+
+    finally:
+        stub.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        shutil.rmtree(ui_utils.OUTPUT_DIR, ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = sum(r['errors'] for r in report['scenarios'])
+    if failed:
+        raise click.ClickException(f"{failed} predictions failed")
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(report, json.load(f), tolerance)
+        if regressions:
+            raise click.ClickException("Performance regressions:\n" + '\n'.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
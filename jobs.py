@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Async jobs, submitted to the DEEPaaS training endpoints.
+
+Jobs are submitted and then polled with exponential backoff, so no UI worker
+nor HTTP connection is tied up while they run. Jobs are polled when their
+history is refreshed in the UI, and the history is persisted in a JSON file so
+that it survives browser reloads and UI restarts.
+
+Each browser only sees its own jobs: they are recorded with a random owner id,
+created in the browser and kept in its local storage.
+"""
+
+import asyncio
+import datetime
+import fcntl
+import json
+import os
+from pathlib import Path
+import tempfile
+import time
+
+import gradio as gr
+
+import ui_utils
+
+
+JOBS_FILE = os.getenv('JOBS_FILE', os.path.join(tempfile.gettempdir(), 'deepaas_ui', 'jobs.json'))
+JOB_POLL_MIN = float(os.getenv('JOB_POLL_MIN', 1))  # first delay (in seconds) between polls of a job
+JOB_POLL_MAX = float(os.getenv('JOB_POLL_MAX', 60))  # max delay between polls
+JOB_REFRESH_INTERVAL = float(os.getenv('JOB_REFRESH_INTERVAL', 5))  # refresh of the history in the UI
+
+# Statuses of the jobs that will not change anymore ("lost" if DEEPaaS forgot
+# the job, eg. it was restarted)
+FINISHED = ['done', 'error', 'cancelled', 'failed', 'lost']
+
+COLUMNS = ['submitted', 'uuid', 'status']
+
+# Owner id of the browser, created on its first visit
+OWNER_JS = """
+() => {
+    let owner = localStorage.getItem('deepaas_ui_jobs_owner');
+    if (!owner) {
+        owner = Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+        localStorage.setItem('deepaas_ui_jobs_owner', owner);
+    }
+    return owner;
+}
+"""
+
+
+class JobStore:
+    """
+    History of the jobs submitted to DEEPaaS, persisted in a JSON file.
+    The file is shared by the UI workers (see workers.py), each one merging
+    the jobs saved by the others.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}  # {uuid: job}
+        self.mtime = None
+        self.sync()
+
+    def sync(self):
+        """
+        Merge the jobs saved in the file since it was last read.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path) as f:
+                jobs = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.mtime = mtime
+        for uuid, job in jobs.items():
+            # The most recently polled copy of a job is the most up to date
+            if uuid not in self.jobs or job['next_poll'] > self.jobs[uuid]['next_poll']:
+                self.jobs[uuid] = job
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.sync()
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path), suffix='.tmp', delete=False) as f:
+                json.dump(self.jobs, f)
+            os.replace(f.name, self.path)
+            self.mtime = os.stat(self.path).st_mtime
+
+    def add(self, model, url, rc, owner):
+        """
+        Record a job just submitted to the model. `url` is the training
+        endpoint of the replica that runs the job.
+        """
+        self.jobs[rc['uuid']] = {
+            'model': model,
+            'owner': owner,
+            'url': f"{url}{rc['uuid']}",  # status endpoint
+            'uuid': rc['uuid'],
+            'status': rc.get('status', 'running'),
+            'submitted': datetime.datetime.now().isoformat(sep=' ', timespec='seconds'),
+            'result': rc,
+            'delay': JOB_POLL_MIN,
+            'next_poll': time.time() + JOB_POLL_MIN,
+            }
+        self.save()
+
+    async def poll_job(self, job):
+        # Schedule the next poll right away, so that concurrent refreshes do
+        # not poll the same job
+        job['next_poll'] = time.time() + job['delay']
+        job['delay'] = min(job['delay'] * 2, JOB_POLL_MAX)
+        try:
+            r = await ui_utils.get_client().get(job['url'], timeout=ui_utils.CONNECT_TIMEOUT)
+        except Exception:
+            return  # DEEPaaS might be busy, try again later
+        if r.status_code == 404:
+            job['status'] = 'lost'
+        elif r.status_code == 200:
+            rc = r.json()
+            job['status'] = rc.get('status', job['status'])
+            job['result'] = rc
+
+    async def poll(self, model):
+        """
+        Poll the running jobs of the model that are due.
+        """
+        self.sync()
+        now = time.time()
+        due = [
+            job for job in self.jobs.values()
+            if job['model'] == model and job['status'] not in FINISHED and job['next_poll'] <= now
+            ]
+        if due:
+            await asyncio.gather(*[self.poll_job(job) for job in due])
+            self.save()
+
+    def get(self, uuid, owner):
+        job = self.jobs.get(uuid)
+        if owner and job and job.get('owner') == owner:
+            return job
+
+    def table(self, model, owner):
+        """
+        History of the jobs of the model submitted by the owner, newest first.
+        """
+        jobs = [
+            job for job in self.jobs.values()
+            if job['model'] == model and owner and job.get('owner') == owner
+            ]
+        jobs.sort(key=lambda job: job['submitted'], reverse=True)
+        return [[job[c] for c in COLUMNS] for job in jobs]
+
+
+store = JobStore(JOBS_FILE)
+
+
+async def submit(
+    *user_args: tuple,  # Gradio input args, introduced by user
+    plan: ui_utils.RequestPlan,  # mapping of the Gradio args to the DEEPaaS args
+    url: str,  # DEEPaaS training endpoint (relative to the DEEPaaS replicas, or absolute)
+    ):
+    """
+    Submit a job to DEEPaaS and return the updated history. The owner id of
+    the browser comes after the Gradio input args.
+    """
+    *user_args, owner = user_args
+    if not owner:
+        raise Exception("Jobs need an owner id")
+    params, files = plan(user_args)
+    model = Path(url).parent.name
+    async with ui_utils.backends.route(url) as call:
+        with ui_utils.MultipartStream(files) as body:
+            r = await ui_utils.get_client().post(
+                url=call.url,
+                headers=body.headers if files else None,
+                params=params,
+                content=body if files else None,
+                )
+        call.failed = r.status_code in ui_utils.BACKEND_FAILURE_STATUSES  # passive health check of the replica
+    if r.status_code not in [200, 201]:
+        raise Exception(r.text)
+
+    # The job is pinned to the replica that runs it
+    store.add(model, call.url, r.json(), owner)
+    return store.table(model, owner)
+
+
+async def refresh(model, owner):
+    """
+    Poll the running jobs of the model and return the updated history of the
+    owner.
+    """
+    await store.poll(model)
+    return store.table(model, owner)
+
+
+def show(owner, table, evt: gr.SelectData):
+    """
+    Return the result of the job selected in the history.
+    """
+    uuid = table.iloc[evt.index[0]]['uuid']
+    return (store.get(uuid, owner) or {}).get('result')
@@ -14,153 +14,452 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
 import inspect
 import functools
 import os
 from pathlib import Path
+import random
+import threading
 import time
 import warnings
 
 import click
+from fastapi.responses import PlainTextResponse
 import gradio as gr
 import requests
 
+import jobs
+import metrics
 import ui_utils
+import workers
 
 
-@click.command()
-@click.option('--api_url',
-              default='http://0.0.0.0:5000/',
-              help='URL of the DEEPaaS API')
-@click.option('--ui_port',
-              default=8000,
-              help='URL of the deployed UI')
-def main(api_url, ui_port):
+def parse_inputs(specs, p):
+    """
+    Retrieve DEEPaaS input params for predict() of the model at path `p`.
+    """
+    api_inp = specs['paths'][p]['post']['parameters']
+    for i in api_inp:
+        # We default type to string because sometimes modules are not using inputs
+        # correctly (eg. YOLOV8: "classes" param)
+        i['type'] = i.get('type', 'string')
+    return api_inp
 
-    # Parse api inference inputs/outputs
-    session = requests.Session()
 
-    # Try to connect several times to DEEPaaS because it might take some time to launch
-    max_retries = int(os.getenv('MAX_RETRIES', 5))
-    i = 0
-    while True:
+def parse_outputs(specs, mime):
+    """
+    Transform DEEPaaS outputs of a given MIME to descriptors of Gradio outputs.
+    Return also whether the module has defined a schema for the JSON output.
+    """
+    schema = False
+    if mime in ['application/json', 'application/x-ndjson']:  # NDJSON lines have the same schema as JSON
         try:
-            r = session.get(url=api_url + 'swagger.json')
-            break
+            # Check if the model has a defined schema
+            api_out = specs['definitions']['ModelPredictionResponse']['properties']
+            gr_out = ui_utils.compile_outputs(api_out)
+            schema = True
         except Exception:
-            print(f"Attempt {i} to connect with DEEPaaS")
-            if i == max_retries:
-                raise Exception("DEEPaaS API not found")
-            else:
-                time.sleep(5)
-                i += 1
+            warnings.warn("""
+                You should define a proper response schema [1] for handling the model output.
+                Fallback: return raw JSON.
+                [1] https://docs.deep-hybrid-datacloud.eu/projects/deepaas/en/stable/user/v2-api.html?highlight=schema#deepaas.model.v2.base.BaseModel.schema
+                """)
+            gr_out = ui_utils.component('JSON')
 
-    specs = r.json()
+    elif mime.startswith('image/'):
+        gr_out = ui_utils.component('Image', type='filepath')
 
-    # Check if a model is found
-    pred_paths = [p for p in specs['paths'].keys() if p.endswith('predict/')]
-    p = pred_paths[0]  # we are only interfacing the first model found
-    if '/deepaas-test/' in p:  # ignore "deepaas-test" dummy placeholder model
-        raise Exception('No model could be found.')
-    print(f'Parsing {Path(p).parent}')
+    elif mime.startswith('audio/'):
+        gr_out = ui_utils.component('Audio', type='filepath')
 
-    # Retrieve DEEPaaS input params for predict()
-    api_inp = specs['paths'][p]['post']['parameters']
-    for i in api_inp:
-        # We default type to string because sometimes modules are not using inputs
-        # correctly (eg. YOLOV8: "classes" param)
-        i['type'] = i.get('type', 'string')
+    elif mime.startswith('video/'):
+        gr_out = ui_utils.component('Video')
 
-    # Create a Gradio tab for each MIME type
-    interfaces = []
-    mimes = specs['paths'][p]['post']['produces']
-    for mime in mimes:
+    elif mime.startswith('application/'):
+        gr_out = ui_utils.component('File')
+
+    else:
+        raise Exception(f'DEEPaaS API output MIME not supported for Gradio rendering: {mime}')
+
+    return gr_out, schema
+
+
+def compile_ui(specs, p):
+    """
+    Compile the spec of the model at path `p` into the descriptors of the
+    Gradio components of each tab. The result can be serialized.
+    """
+    api_inp = parse_inputs(specs, p)
+    tabs = {}
+    for mime in specs['paths'][p]['post']['produces']:
 
         # Ignore default mime "*/*"
         if mime == '*/*':
             continue
         print(f"Processing MIME: {mime}")
 
-        # Transform deepaas inputs to Gradio
-        gr_inp = ui_utils.api2gr_inputs(api_inp)
-
-        # Transform deepaas outputs to Gradio
-        schema = False
-        if mime == 'application/json':
-            try:
-                # Check if the model has a defined schema
-                api_out = specs['definitions']['ModelPredictionResponse']['properties']
-                gr_out = ui_utils.api2gr_outputs(api_out)
-                schema = True
-            except Exception:
-                warnings.warn("""
-                    You should define a proper response schema [1] for handling the model output.
-                    Fallback: return raw JSON.
-                    [1] https://docs.deep-hybrid-datacloud.eu/projects/deepaas/en/stable/user/v2-api.html?highlight=schema#deepaas.model.v2.base.BaseModel.schema
-                    """)
-                gr_out = gr.JSON()
-
-        elif mime.startswith('image/'):
-            gr_out = gr.Image(type='filepath')
-
-        elif mime.startswith('audio/'):
-            gr_out = gr.Audio(type='filepath')
-
-        elif mime.startswith('video/'):
-            gr_out = gr.Video()
-
-        elif mime.startswith('application/'):
-            gr_out = gr.File()
+        gr_out, schema = parse_outputs(specs, mime)
+        tabs[mime] = {'outputs': gr_out, 'schema': schema}
+
+    ui = {
+        'api_inp': api_inp,
+        'inputs': ui_utils.compile_inputs(api_inp),
+        'tabs': tabs,
+        }
+
+    # Models whose trainings can be submitted and polled also get a tab for
+    # async jobs
+    t = f'{Path(p).parent}/train/'
+    polled = any(q.startswith(t) and '{' in q and 'get' in specs['paths'][q] for q in specs['paths'])
+    if 'post' in specs['paths'].get(t, {}) and polled:
+        print("Processing async jobs")
+        api_inp = parse_inputs(specs, t)
+        ui['jobs'] = {
+            'url': t,
+            'api_inp': api_inp,
+            'inputs': ui_utils.compile_inputs(api_inp),
+            }
+
+    return ui
 
-        else:
-            raise Exception(f'DEEPaaS API output MIME not supported for Gradio rendering: {mime}')
-
-        # Create an api call with non-user parameter pre-filled
-        api_call = functools.partial(
-            ui_utils.api_call,
-            api_inp=api_inp,
-            gr_out=gr_out,
-            url='/'.join(s.strip('/') for s in [api_url, p]),
-            mime=mime,
-            schema=schema,
-            )
 
-        # Get model metadata
-        r = session.get(f'{api_url}/{Path(p).parent}/')
-        metadata = r.json()
+@contextlib.contextmanager
+def phase(name):
+    """
+    Log the time spent in a startup phase.
+    """
+    start = time.perf_counter()
+    yield
+    print(f"{name} took {time.perf_counter() - start:.2f}s")
+
+
+def wait_for_api(session, api_url, max_wait, max_delay=5):
+    """
+    Poll DEEPaaS until it answers, with exponential backoff (and jitter) between
+    attempts, and give up after `max_wait` seconds.
+    """
+    start = time.monotonic()
+    delay = 0.1  # first retries are fast, in case DEEPaaS is almost ready
+    i = 0
+    while True:
+        try:
+            r = session.get(url=api_url + 'swagger.json', timeout=max_delay)
+            r.raise_for_status()
+            return r
+        except Exception:
+            print(f"Attempt {i} to connect with DEEPaaS")
+            remaining = max_wait - (time.monotonic() - start)
+            if remaining <= 0:
+                raise Exception("DEEPaaS API not found")
+            time.sleep(min(delay * random.uniform(0.5, 1), remaining))
+            delay = min(delay * 2, max_delay)
+            i += 1
+
+
+def build_interface(ui, url):
+    """
+    Build the Gradio interface of a model from its compiled UI (see
+    `compile_ui`). The model is served at `url`, relative to the DEEPaaS
+    replicas (keep its trailing slash to avoid redirects).
+    """
+    metadata = ui['metadata']
+    plan = ui_utils.RequestPlan(ui['api_inp'])  # shared by all the tabs
+
+    # Options shared by all the tabs
+    common = dict(
+        title=metadata.get('name', ''),
+        description=ui_utils.generate_header(),
+        article=ui_utils.generate_footer(metadata),
+        theme=gr.themes.Default(
+            primary_hue=gr.themes.colors.cyan,
+            ),
+        # Gradio keeps its own copy of the outputs, expire them like ours
+        delete_cache=(int(ui_utils.OUTPUT_SWEEP_INTERVAL), int(ui_utils.OUTPUT_TTL)),
+        )
+
+    # Create a Gradio tab for each MIME type
+    interfaces, tab_names = [], []
+    calls = {}  # {mime: (api call, Gradio outputs)} of the non-streaming tabs
+    for mime, tab in ui['tabs'].items():
+
+        # Build the Gradio inputs/outputs
+        gr_inp = ui_utils.build_components(ui['inputs'])
+        gr_out = ui_utils.build_components(tab['outputs'])
+
+        # Create an api call with non-user parameter pre-filled.
+        # NDJSON responses are streamed to Gradio as they arrive.
+        if mime == 'application/x-ndjson':
+            api_call = functools.partial(
+                ui_utils.stream_call,
+                plan=plan,
+                gr_out=gr_out,
+                url=url,
+                mime=mime,
+                schema=tab['schema'],
+                )
+        else:
+            api_call = functools.partial(
+                ui_utils.api_call,
+                plan=plan,
+                gr_out=gr_out,
+                url=url,
+                mime=mime,
+                schema=tab['schema'],
+                cache=metadata.get('deterministic', True),  # modules can opt out of caching
+                )
+            calls[mime] = (api_call, gr_out)
 
         # Launch Gradio interface
         interface = gr.Interface(
             fn=api_call,
             inputs=gr_inp,
             outputs=gr_out,
-            title=metadata.get('name', ''),
-            description=ui_utils.generate_header(),
-            article=ui_utils.generate_footer(metadata),
-            theme=gr.themes.Default(
-                primary_hue=gr.themes.colors.cyan,
+            **common,
+            )
+
+        interfaces.append(interface)
+        tab_names.append(mime)
+
+    # Create a batch tab to run predictions over many files.
+    # Predictions are returned as JSON if possible.
+    if calls and plan.file_slot is not None:
+        mime = 'application/json' if 'application/json' in calls else list(calls)[0]
+        api_call, gr_out = calls[mime]
+        gr_inp = ui_utils.build_components(ui['inputs'])
+        k = plan.file_slot
+        gr_inp[k] = gr.File(
+            file_count='multiple',
+            label=f"{gr_inp[k].label} (several files or zip)",
+            )
+        interface = gr.Interface(
+            fn=functools.partial(
+                ui_utils.batch_call,
+                api_call=api_call,
+                plan=plan,
+                gr_out=gr_out,
                 ),
+            inputs=gr_inp,
+            outputs=[
+                gr.JSON(label='results'),
+                gr.File(label='download results'),
+                ],
+            **common,
             )
+        interfaces.append(interface)
+        tab_names.append('Batch')
+
+    # Create a tab to submit async jobs, and follow them
+    if 'jobs' in ui:
+        with gr.Blocks(title=common['title'], theme=common['theme']) as interface:
+            gr.Markdown(
+                "Jobs run in the background: you can leave the page and come back later. "
+                "Select a job to see its result."
+                )
+            with gr.Row():
+                with gr.Column():
+                    gr_inp = ui_utils.build_components(ui['jobs']['inputs'])
+                    submit = gr.Button('Submit job', variant='primary')
+                with gr.Column():
+                    history = gr.Dataframe(
+                        headers=jobs.COLUMNS,
+                        label='jobs',
+                        interactive=False,
+                        )
+                    result = gr.JSON(label='result')
+            owner = gr.Textbox(visible=False)  # owner id of the browser (see jobs.py)
 
+            submit.click(
+                functools.partial(
+                    jobs.submit,
+                    plan=ui_utils.RequestPlan(ui['jobs']['api_inp']),
+                    url=ui['jobs']['url'],
+                    ),
+                inputs=gr_inp + [owner],
+                outputs=history,
+                api_name='submit_job',
+                )
+            history.select(jobs.show, inputs=[owner, history], outputs=result, show_api=False)
+            refresh = functools.partial(jobs.refresh, Path(url).parent.name)
+            interface.load(None, outputs=owner, js=jobs.OWNER_JS, show_api=False).then(
+                refresh,
+                inputs=owner,
+                outputs=history,
+                show_api=False,
+                )
+            interface.load(
+                refresh,
+                inputs=owner,
+                outputs=history,
+                every=jobs.JOB_REFRESH_INTERVAL,
+                show_api=False,
+                )
         interfaces.append(interface)
+        tab_names.append('Jobs')
 
-    # If more than one MIME type is present, create a tabbed interface
+    # If more than one tab is present, create a tabbed interface
     if len(interfaces) > 1:
         interface = gr.TabbedInterface(
             interface_list = interfaces,
-            tab_names=mimes,
+            tab_names=tab_names,
+        )
+
+    return interface
+
+
+def render_lazily(tab, build):
+    """
+    Render the interface returned by `build()` the first time that `tab` is
+    opened (once per user session, Gradio renders are not shared).
+    """
+    opened = gr.State(False)
+    tab.select(lambda: True, None, opened, show_api=False)  # the state only changes the first time
+
+    @gr.render(inputs=opened, triggers=[opened.change])
+    def render(opened):
+        if opened:
+            build().render()
+
+
+@click.command()
+@click.option('--api_url',
+              default='http://0.0.0.0:5000/',
+              help='URL of the DEEPaaS API. Several replicas can be given as a comma-separated '
+                   'list of URLs, or as @file (one URL per line, re-read when it changes)')
+@click.option('--ui_port',
+              default=8000,
+              help='URL of the deployed UI')
+@click.option('--record',
+              envvar='TRAFFIC_LOG',
+              default='',
+              help='File where the shapes of the predictions are logged, to be replayed by loadtest.py')
+def main(api_url, ui_port, record):
+    os.environ['TRAFFIC_LOG'] = record  # passed on to the workers
+
+    # Serve the UI from several worker processes (each one running this same
+    # function), behind a proxy with sticky sessions
+    if ui_utils.UI_WORKERS > 1 and not ui_utils.UI_WORKER:
+        workers.serve(api_url, ui_port, ui_utils.UI_WORKERS)
+        return
+
+    # Log the shapes of the predictions (the workers share the file)
+    if record:
+        ui_utils.recorder = ui_utils.TrafficRecorder(record)
+
+    start = time.perf_counter()
+
+    # Resolve the UI version in the background while DEEPaaS starts
+    threading.Thread(target=ui_utils.get_version, daemon=True).start()
+
+    # Parse api inference inputs/outputs
+    session = requests.Session()
+
+    # Try to connect several times to DEEPaaS because it might take some time to launch.
+    # The spec is discovered from the first replica.
+    source, api_url = api_url, ui_utils.read_backends(api_url)[0] + '/'
+    with phase('Connecting to DEEPaaS'):
+        max_wait = int(os.getenv('MAX_RETRIES', 5)) * 5  # same time budget as before (retries every 5s)
+        r = wait_for_api(session, api_url, max_wait=max_wait)
+        specs = r.json()
+
+    # Balance the predictions among the replicas serving the same spec
+    ui_utils.backends = ui_utils.Backends(
+        source,
+        spec_hash=ui_utils.spec_hash(specs),
+        verified=[api_url.rstrip('/')],
         )
+    print(f"DEEPaaS replicas: {', '.join(ui_utils.backends.replicas)}")
+
+    # Check if models are found (ignore "deepaas-test" dummy placeholder model)
+    pred_paths = [
+        p for p in specs['paths'].keys()
+        if p.endswith('predict/') and '/deepaas-test/' not in p
+        ]
+    if not pred_paths:
+        raise Exception('No model could be found.')
+
+    # Compile the spec into the UI of each model (inputs, outputs and metadata),
+    # unless it was already done for the same spec
+    key = ui_utils.ui_cache_key(specs)
+    uis = ui_utils.load_ui_cache(key)
+    if uis is None:
+        with phase('Compiling the spec'):
+            uis = {}
+            for p in pred_paths:
+                print(f'Parsing {Path(p).parent}')
+                uis[p] = compile_ui(specs, p)
+
+                # Get model metadata (once, shared by all tabs)
+                r = session.get(
+                    f'{api_url}/{Path(p).parent}/',
+                    timeout=(ui_utils.CONNECT_TIMEOUT, ui_utils.READ_TIMEOUT),
+                    )
+                uis[p]['metadata'] = r.json()
+
+        ui_utils.save_ui_cache(key, uis)
+    else:
+        print('Loaded the UI from the cache')
+
+    # Build the Gradio interface
+    build_start = time.perf_counter()
 
-    interface.launch(
+    if len(pred_paths) == 1:
+        p = pred_paths[0]
+        interface = build_interface(uis[p], p)
+
+    else:
+        # Create a tab for each model. Only the first one is built at startup,
+        # the others are built when they are opened, unless disabled (lazy
+        # models are not listed in the Gradio API).
+        lazy = os.getenv('LAZY_MODELS', 'true').lower() in ['true', '1']
+        interface = gr.Blocks(
+            title='DEEPaaS',
+            theme=gr.themes.Default(
+                primary_hue=gr.themes.colors.cyan,
+                ),
+            delete_cache=(int(ui_utils.OUTPUT_SWEEP_INTERVAL), int(ui_utils.OUTPUT_TTL)),
+            )
+        with interface:
+            with gr.Tabs():
+                for k, p in enumerate(pred_paths):
+                    with gr.Tab(Path(p).parent.name) as tab:
+                        build = functools.partial(build_interface, uis[p], p)
+                        if k == 0 or not lazy:
+                            build().render()
+                        else:
+                            render_lazily(tab, build)
+
+    print(f"Building the interface took {time.perf_counter() - build_start:.2f}s")
+
+    # Periodically clean the prediction outputs
+    ui_utils.output_store.start_sweeper(ui_utils.OUTPUT_SWEEP_INTERVAL)
+
+    # Let Gradio hand all predictions to api_call, where admission is controlled
+    # (Gradio's limit applies per event, so predictions beyond it would wait in
+    # Gradio's unbounded queue instead of being rejected)
+    interface.queue(default_concurrency_limit=None)
+
+    app, _, _ = interface.launch(
         inline=False,
-        inbrowser=True,
-        server_name="0.0.0.0",
+        inbrowser=not ui_utils.UI_WORKER,
+        server_name="127.0.0.1" if ui_utils.UI_WORKER else "0.0.0.0",  # workers are only reached through the proxy
         server_port=ui_port,
         show_error = True,
         debug=False,
-        favicon_path='./_static/images/favicon.ico'
+        favicon_path='./_static/images/favicon.ico',
+        prevent_thread_lock=True,
     )
 
+    # Expose the metrics of the UI, in the Prometheus format
+    app.add_api_route(
+        '/metrics',
+        lambda: PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4'),
+        methods=['GET'],
+        )
+
+    print(f"UI ready in {time.perf_counter() - start:.2f}s")
+    interface.block_thread()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Load test of a deployed UI (or of DEEPaaS straight away).
+
+It replays the traffic logged by the UI (see `--record` in `launch.py`), or a
+synthetic mix of predictions derived from the DEEPaaS spec, at a target rate,
+and reports latency percentiles and throughput. The inputs are synthetic, with
+the shapes of the recorded ones (file sizes, lengths of strings and arrays).
+
+Predictions are sent in open loop: they start at their scheduled time even if
+previous ones have not finished, and their latency is measured from that time,
+so queueing in the client is not hidden.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import warnings
+
+import click
+import httpx
+import numpy as np
+from PIL import Image
+
+
+# Keep the outputs of the UI modules imported below apart from the outputs of a
+# running UI, as they are removed at the end
+OUTPUT_DIR = os.environ['OUTPUT_DIR'] = tempfile.mkdtemp(prefix='deepaas_ui_loadtest_')
+
+import launch  # noqa: E402
+from metrics import percentile  # noqa: E402
+import stub_deepaas  # noqa: E402
+import ui_utils  # noqa: E402
+from workers import free_port  # noqa: E402
+
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp']
+
+
+def load_trace(path):
+    """
+    Read the predictions of a traffic log, with their offset (in seconds) from
+    the first one.
+    """
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda e: e['t'])
+    for e in entries:
+        e['offset'] = e['t'] - entries[0]['t']
+    return entries
+
+
+def synthetic_mix(specs, p, n, upload_size):
+    """
+    Generate `n` predictions with the default values of the inputs of the
+    model at path `p`, spread among its MIMEs.
+    """
+    mimes = [m for m in specs['paths'][p]['post']['produces'] if m != '*/*']
+    params, files = {}, {}
+    for i in launch.parse_inputs(specs, p):
+        if i['name'] == 'accept':
+            continue
+        if i['type'] == 'file':
+            files[i['name']] = {'bytes': upload_size, 'ext': '.png'}
+        elif 'default' in i or 'enum' in i:
+            v = i.get('default', (i.get('enum') or [None])[0])
+            params[i['name']] = v if v is None or isinstance(v, (bool, int, float)) else {'len': len(str(v))}
+        elif i['type'] in ['integer', 'number']:
+            params[i['name']] = i.get('minimum', 1)
+        elif i['type'] == 'boolean':
+            params[i['name']] = False
+        elif i['type'] == 'array':
+            params[i['name']] = {'items': 1}
+        elif i.get('required'):
+            params[i['name']] = {'len': 8}
+    return [
+        {'url': p, 'mime': random.choice(mimes), 'params': params, 'files': files}
+        for _ in range(n)
+        ]
+
+
+def schedule(entries, rate, speed):
+    """
+    Set the offsets of the predictions: Poisson arrivals at `rate` predictions
+    per second, or the recorded arrivals sped up by `speed`.
+    """
+    t = 0
+    for e in entries:
+        if rate:
+            t += random.expovariate(rate)
+            e['offset'] = t
+        else:
+            e['offset'] = e['offset'] / speed
+    return entries
+
+
+class Inputs:
+    """
+    Synthetic values of the inputs of a model, with the recorded shapes.
+    Files are generated once per size and extension.
+    """
+
+    def __init__(self, api_inp, tmpdir):
+        self.specs = {i['name']: i for i in api_inp}
+        self.tmpdir = tmpdir
+        self.files = {}
+
+    def file(self, shape):
+        key = (shape['bytes'], shape['ext'])
+        if key not in self.files:
+            path = os.path.join(self.tmpdir, f'input-{len(self.files)}{shape["ext"]}')
+            if shape['ext'] in IMAGE_EXTENSIONS:
+                # Noise images do not compress, so their size is close to the recorded one
+                side = max(int((shape['bytes'] / 3) ** 0.5), 1)
+                pixels = np.random.randint(0, 256, (side, side, 3), dtype=np.uint8)
+                Image.fromarray(pixels).save(path)
+            else:
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(shape['bytes']))
+            self.files[key] = path
+        return self.files[key]
+
+    def value(self, name, shape):
+        if not isinstance(shape, dict):
+            return shape
+        spec = self.specs.get(name, {})
+        if 'items' in shape:
+            return ['x'] * shape['items']
+        if 'enum' in spec or 'default' in spec:
+            return spec.get('default', (spec.get('enum') or [''])[0])
+        return 'x' * shape['len']
+
+    def __call__(self, entry):
+        params = {k: self.value(k, v) for k, v in entry['params'].items()}
+        files = {k: self.file(v) for k, v in entry['files'].items()}
+        return params, files
+
+
+class UITarget:
+    """
+    Send the predictions to a deployed UI, through its Gradio API.
+    """
+
+    def __init__(self, ui_url, specs, p, max_concurrency):
+        from gradio_client import Client, handle_file
+
+        self.client = Client(ui_url, verbose=False)
+        self.handle_file = handle_file
+        self.plan = ui_utils.RequestPlan(launch.parse_inputs(specs, p))
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+
+        # Each MIME has its own tab, named after the Gradio function
+        # (this assumes a single model in the UI)
+        mimes = [m for m in specs['paths'][p]['post']['produces'] if m != '*/*']
+        self.api_names = {m: '/predict' + (f'_{k}' if k else '') for k, m in enumerate(mimes)}
+
+    def args(self, params, files):
+        """
+        Gradio args of the prediction, following the layout of `RequestPlan`.
+        """
+        n = max(i.index + (2 if i.is_file else 1) for i in self.plan.inputs)
+        args = [''] * n  # info components of the files are empty
+        for i in self.plan.inputs:
+            if i.is_file:
+                v = files.get(i.name)
+                args[i.index] = self.handle_file(v) if v else None
+            elif i.convert is ui_utils._to_array:
+                args[i.index] = json.dumps(params[i.name])[1:-1] if i.name in params else ''
+            else:
+                args[i.index] = params.get(i.name)
+        return args
+
+    async def __call__(self, mime, params, files):
+        call = functools.partial(
+            self.client.predict,
+            *self.args(params, files),
+            api_name=self.api_names[mime],
+            )
+        await asyncio.get_event_loop().run_in_executor(self.pool, call)
+
+    async def close(self):
+        self.pool.shutdown()
+
+
+class DEEPaaSTarget:
+    """
+    Send the predictions straight to DEEPaaS, to measure the UI overhead by
+    comparison.
+    """
+
+    def __init__(self, api_url, p, max_concurrency):
+        self.url = api_url.rstrip('/') + p
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(ui_utils.CONNECT_TIMEOUT, read=ui_utils.READ_TIMEOUT),
+            limits=httpx.Limits(max_connections=max_concurrency),
+            )
+
+    async def __call__(self, mime, params, files):
+        handles = {k: open(v, 'rb') for k, v in files.items()}
+        try:
+            r = await self.client.post(
+                self.url,
+                headers={'accept': mime},
+                params={**params, 'accept': mime},
+                files=handles or None,
+                )
+        finally:
+            for f in handles.values():
+                f.close()
+        if r.status_code != 200:
+            raise Exception(f"{r.status_code}: {r.text[:200]}")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+async def replay(target, entries, inputs, max_concurrency):
+    """
+    Send the predictions at their scheduled offsets, up to `max_concurrency`
+    at a time. Return the results (MIME, latency in seconds, success) and the
+    total time.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = []
+
+    async def predict(e, scheduled):
+        params, files = inputs(e)
+        async with semaphore:
+            try:
+                await target(e['mime'], params, files)
+                ok = True
+            except Exception as exc:
+                print(f"Prediction failed: {exc}")
+                ok = False
+        results.append((e['mime'], time.perf_counter() - scheduled, ok))
+
+    start = time.perf_counter()
+    tasks = []
+    for e in entries:
+        delay = start + e['offset'] - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(predict(e, start + e['offset'])))
+    await asyncio.gather(*tasks)
+    total = time.perf_counter() - start
+    await target.close()
+    return results, total
+
+
+def summarize(name, results, total):
+    latencies = [seconds for _, seconds, _ in results]
+    ok = sum(1 for *_, success in results if success)
+    return {
+        'scenario': name,
+        'requests': len(results),
+        'errors': len(results) - ok,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput': ok / total,
+        }
+
+
+@click.command()
+@click.option('--trace',
+              default=None,
+              help='Traffic log to replay (see `--record` in launch.py). '
+                   'If not given, a synthetic mix is derived from the DEEPaaS spec')
+@click.option('--ui_url',
+              default='http://127.0.0.1:8000',
+              help='URL of the UI under test')
+@click.option('--api_url',
+              default='http://127.0.0.1:5000',
+              help='URL of DEEPaaS, to read the spec (and to send the predictions with --direct)')
+@click.option('--direct',
+              is_flag=True,
+              help='Send the predictions straight to DEEPaaS instead of the UI')
+@click.option('--stub',
+              is_flag=True,
+              help='Send the predictions straight to a local stub DEEPaaS (see stub_deepaas.py)')
+@click.option('--rate',
+              default=None,
+              type=float,
+              help='Predictions per second (Poisson arrivals). '
+                   'By default, the recorded arrivals, or 10/s for the synthetic mix')
+@click.option('--speed',
+              default=1.0,
+              help='Speed-up of the recorded arrivals')
+@click.option('--requests', 'n_requests',
+              default=None,
+              type=int,
+              help='Number of predictions (by default, the whole trace, or 100 synthetic ones)')
+@click.option('--max_concurrency',
+              default=64,
+              help='Maximum number of predictions in flight')
+@click.option('--upload_size',
+              default=64 * 1024,
+              help='Size (in bytes) of the input files of the synthetic mix')
+@click.option('--output',
+              default=None,
+              help='Save the report to this JSON file')
+def main(trace, ui_url, api_url, direct, stub, rate, speed, n_requests, max_concurrency, upload_size, output):
+    warnings.simplefilter('ignore')
+    tmpdir = tempfile.mkdtemp()
+    proc = None
+    try:
+        if stub:
+            port = free_port()
+            api_url = f'http://127.0.0.1:{port}'
+            proc = stub_deepaas.start(port)
+            direct = True
+        specs = httpx.get(f'{api_url.rstrip("/")}/swagger.json').json()
+
+        if trace:
+            entries = load_trace(trace)[:n_requests]
+            p = entries[0]['url']
+            if stub:
+                # The stub serves a single model, so recorded paths are mapped to it
+                p = f'{stub_deepaas.MODEL_PATH}/predict/'
+                entries = [{**e, 'url': p} for e in entries]
+            entries = [e for e in entries if e['url'] == p]  # a single model is tested
+        else:
+            p = next(q for q in specs['paths'] if q.endswith('predict/') and '/deepaas-test/' not in q)
+            entries = synthetic_mix(specs, p, n_requests or 100, upload_size)
+            rate = rate or 10
+        entries = schedule(entries, rate, speed)
+
+        if direct:
+            target = DEEPaaSTarget(api_url, p, max_concurrency)
+        else:
+            target = UITarget(ui_url, specs, p, max_concurrency)
+        inputs = Inputs(launch.parse_inputs(specs, p), tmpdir)
+
+        print(f"Sending {len(entries)} predictions to {'DEEPaaS' if direct else 'the UI'} ({p})")
+        results, total = asyncio.run(replay(target, entries, inputs, max_concurrency))
+
+    finally:
+        if proc:
+            proc.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+
+    by_mime = collections.defaultdict(list)
+    for r in results:
+        by_mime[r[0]].append(r)
+    report = {
+        'target': api_url if direct else ui_url,
+        'seconds': total,
+        'scenarios': [summarize('all', results, total)] + [
+            summarize(mime, rs, total) for mime, rs in sorted(by_mime.items())
+            ],
+        }
+
+    print(f"{'scenario':<28} {'requests':>8} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8}")
+    for r in report['scenarios']:
+        print(
+            f"{r['scenario']:<28} {r['requests']:>8} {r['errors']:>6} {r['p50_ms']:>7.1f}ms "
+            f"{r['p95_ms']:>7.1f}ms {r['p99_ms']:>7.1f}ms {r['throughput']:>8.1f}"
+            )
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
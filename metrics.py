@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Minimal metrics registry, rendered in the Prometheus text format.
+"""
+
+import bisect
+import collections
+import contextlib
+import math
+import os
+import threading
+import time
+
+
+# Buckets (in seconds) of the latency histograms
+BUCKETS = [
+    float(b) for b in os.getenv(
+        'METRICS_BUCKETS',
+        '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300',
+        ).split(',')
+    ]
+
+registry = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels
+        )
+    return f'{{{labels}}}'
+
+
+class Metric:
+    """
+    Base metric. Values are stored per set of labels.
+    """
+    type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = collections.defaultdict(float)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} {self.type}',
+            ]
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] += amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Callback(Metric):
+    """
+    Metric whose value is read from a function when rendered.
+    """
+
+    def __init__(self, name, description, fn, type='gauge'):
+        super().__init__(name, description)
+        self.fn = fn
+        self.type = type
+
+    def samples(self):
+        return [(self.name, (), self.fn())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=None):
+        super().__init__(name, description)
+        self.buckets = sorted(buckets or BUCKETS)
+        self.counts = {}  # {labels: [count per bucket]}
+        self.sums = collections.defaultdict(float)
+
+    def observe(self, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            if labels not in self.counts:
+                self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.counts[labels][bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[labels] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, counts in self.counts.items():
+                total = 0
+                for le, count in zip(self.buckets + ['+Inf'], counts):
+                    total += count
+                    samples.append((f'{self.name}_bucket', labels + (('le', le),), total))
+                samples.append((f'{self.name}_sum', labels, self.sums[labels]))
+                samples.append((f'{self.name}_count', labels, total))
+        return samples
+
+
+class StageTimer:
+    """
+    Accumulate the time spent in each stage of a call. Time spent in a stage
+    nested inside another one is only counted in the inner stage.
+    """
+
+    def __init__(self):
+        self.stages = collections.defaultdict(float)
+        self.stack = []  # time spent in nested stages
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        self.stack.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[stage] += elapsed - self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+
+
+def percentile(values, q):
+    # Nearest-rank percentile, for the reports of benchmark.py and loadtest.py
+    values = sorted(values)
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+def render():
+    """
+    Render all the metrics in the Prometheus text format.
+    """
+    return '\n'.join(m.render() for m in registry) + '\n'
+
+
+def merge(texts, label):
+    """
+    Merge the metrics rendered by several processes, telling their samples
+    apart with a `label` (the index of the process in `texts`).
+    """
+    families = {}  # {name: (header lines, sample lines)}, in order of appearance
+    for k, text in enumerate(texts):
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                name = line.split(' ', 3)[2]
+                header, _ = families.setdefault(name, ([], []))
+                if line not in header:
+                    header.append(line)
+            elif line and name is not None:
+                sample, brace, rest = line.partition('{')
+                if brace:
+                    line = f'{sample}{{{label}="{k}",{rest}'
+                else:
+                    sample, _, value = line.partition(' ')
+                    line = f'{sample}{{{label}="{k}"}} {value}'
+                families[name][1].append(line)
+    return ''.join(
+        '\n'.join(header + samples) + '\n'
+        for header, samples in families.values()
+        )
@@ -7,6 +7,11 @@ if [ -n "$NOMAD_HOST_ADDR_api" ]; then \
     export DEEPAAS_URL=$NOMAD_HOST_ADDR_api; \
 fi
 
+# Run one UI worker per available core, if requested
+if [ "$UI_WORKERS" = "auto" ]; then \
+    export UI_WORKERS=$(nproc); \
+fi
+
 # Use the "-u" flag to show Python print in Docker logs
 # Use "||[...]" to capture the exit code of timeout (124) and return a success code
 timeout $DURATION \
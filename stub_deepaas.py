@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Stub DEEPaaS API, to benchmark and test the UI offline.
+
+It serves a `swagger.json` (a default one or a custom one) and answers every
+predict endpoint with synthetic outputs of a configurable size:
+* `application/json` + `output=json`: JSON with a list of numbers,
+* `application/json` + `output=media`: JSON with a base64-encoded image,
+* `application/x-ndjson`: the JSON output, streamed as several lines with the
+  progress of the prediction,
+* any other MIME: raw binary.
+
+Predictions with `texts` (a batch input, see the `#batch` tag) answer instead
+with one number per text (its length), whatever the size of the batch.
+
+Size of the outputs (`size`, in bytes) and inference time (`latency`, in
+seconds) are set by predict params.
+
+It also serves the training endpoints, with synthetic jobs that finish after
+`duration` seconds, to test the async jobs of the UI.
+"""
+
+import asyncio
+import base64
+import datetime
+import functools
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+import uuid
+
+import click
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import httpx
+import uvicorn
+
+
+MODEL_PATH = '/v2/models/stub'
+
+SPEC = {
+    'swagger': '2.0',
+    'info': {'title': 'DEEPaaS API (stub)', 'version': '2.0'},
+    'paths': {
+        f'{MODEL_PATH}/': {
+            'get': {'summary': 'Return model metadata'},
+            },
+        f'{MODEL_PATH}/predict/': {
+            'post': {
+                'summary': 'Make a prediction given the input data',
+                'produces': ['application/json', 'application/x-ndjson', 'image/png', '*/*'],
+                'parameters': [
+                    {
+                        'name': 'data',
+                        'in': 'formData',
+                        'type': 'file',
+                        'description': 'Input image',
+                        },
+                    {
+                        'name': 'size',
+                        'in': 'formData',
+                        'type': 'integer',
+                        'default': 1024,
+                        'description': 'Size (in bytes) of the synthetic output',
+                        },
+                    {
+                        'name': 'latency',
+                        'in': 'formData',
+                        'type': 'number',
+                        'default': 0,
+                        'description': 'Simulated inference time (in seconds)',
+                        },
+                    {
+                        'name': 'output',
+                        'in': 'formData',
+                        'type': 'string',
+                        'enum': ['media', 'json'],
+                        'default': 'media',
+                        'description': 'Shape of the JSON output',
+                        },
+                    {
+                        'name': 'texts',
+                        'in': 'query',
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                        'description': 'Texts to measure, in batches #batch=8',
+                        },
+                    {
+                        'name': 'accept',
+                        'in': 'query',
+                        'type': 'string',
+                        'enum': ['application/json', 'application/x-ndjson', 'image/png', '*/*'],
+                        'default': 'application/json',
+                        },
+                    ],
+                },
+            },
+        f'{MODEL_PATH}/train/': {
+            'get': {'summary': 'Get the list of trainings'},
+            'post': {
+                'summary': 'Retrain the model',
+                'parameters': [
+                    {
+                        'name': 'epochs',
+                        'in': 'query',
+                        'type': 'integer',
+                        'default': 3,
+                        'description': 'Number of epochs',
+                        },
+                    {
+                        'name': 'duration',
+                        'in': 'query',
+                        'type': 'number',
+                        'default': 5,
+                        'description': 'Duration (in seconds) of the synthetic training',
+                        },
+                    ],
+                },
+            },
+        f'{MODEL_PATH}/train/{{uuid}}': {
+            'get': {'summary': 'Get the status of a training'},
+            },
+        },
+    'definitions': {
+        'ModelPredictionResponse': {
+            'properties': {
+                'text': {'type': 'string', 'description': 'Some text'},
+                'numbers': {'type': 'array', 'description': 'Some numbers'},
+                'image': {'type': 'string', 'description': 'Output image (base64)'},
+                },
+            },
+        },
+    }
+
+METADATA = {
+    'name': 'stub',
+    'author': 'DEEPaaS UI',
+    'description': 'Stub model that returns synthetic outputs',
+    }
+
+CHUNK_SIZE = 1024 * 1024
+STREAM_LINES = 5  # lines of the NDJSON outputs
+
+
+@functools.lru_cache(maxsize=16)
+def payload(size):
+    return os.urandom(size)
+
+
+@functools.lru_cache(maxsize=16)
+def json_payload(size, output):
+    # Serialized once, so that the stub is not the bottleneck of benchmarks
+    if output == 'json':
+        rc = {'text': 'ok', 'numbers': [i / 3 for i in range(max(size // 20, 1))]}  # ~20 bytes/number
+    else:
+        rc = {'text': 'ok', 'image': base64.b64encode(payload(size)).decode('utf-8')}
+    return json.dumps(rc).encode('utf-8')
+
+
+def create_app(spec=None, metadata=None):
+    """
+    Create the stub DEEPaaS app, optionally serving a custom swagger spec.
+    """
+    spec = spec or SPEC
+    metadata = metadata or METADATA
+    trainings = {}  # {uuid: job}
+    app = FastAPI()
+
+    @app.get('/swagger.json')
+    async def swagger():
+        return spec
+
+    @app.get('/v2/models/{name}/')
+    async def get_metadata(name: str):
+        return dict(metadata, name=name)
+
+    @app.post('/v2/models/{name}/predict/')
+    async def predict(name: str, request: Request):
+        form = await request.form()
+        args = dict(request.query_params)
+        args.update({k: v for k, v in form.items() if isinstance(v, str)})
+
+        # Consume the uploaded files, like a model would
+        for v in form.values():
+            if not isinstance(v, str):
+                while await v.read(CHUNK_SIZE):
+                    pass
+        await form.close()
+
+        size = int(args.get('size', 1024))
+        latency = float(args.get('latency', 0))
+        accept = args.get('accept', 'application/json')
+
+        # Batched predictions take the same time as single ones
+        texts = request.query_params.getlist('texts')
+        if texts and accept == 'application/json':
+            await asyncio.sleep(latency)
+            return JSONResponse({'text': 'ok', 'numbers': [len(t) for t in texts]})
+
+        if accept == 'application/x-ndjson':
+            data = json_payload(size, args.get('output', 'media'))
+
+            async def lines():
+                # The inference time is spread among the lines
+                for k in range(1, STREAM_LINES + 1):
+                    await asyncio.sleep(latency / STREAM_LINES)
+                    yield b'{"progress": %.2f, ' % (k / STREAM_LINES) + data[1:] + b'\n'
+
+            return StreamingResponse(lines(), media_type=accept)
+
+        await asyncio.sleep(latency)
+        if accept == 'application/json':
+            data = json_payload(size, args.get('output', 'media'))
+        else:
+            data = payload(size)
+
+        def chunks():
+            for k in range(0, len(data), CHUNK_SIZE):
+                yield data[k:k + CHUNK_SIZE]
+
+        return StreamingResponse(chunks(), media_type=accept)
+
+    def training_status(job):
+        rc = {k: job[k] for k in ['uuid', 'date', 'status']}
+        if time.monotonic() - job['start'] >= job['duration']:
+            rc['status'] = 'done'
+            rc['result'] = {'epochs': job['epochs'], 'loss': round(1 / (job['epochs'] + 1), 4)}
+        return rc
+
+    @app.post('/v2/models/{name}/train/')
+    async def train(name: str, request: Request):
+        args = dict(request.query_params)
+        job = {
+            'uuid': uuid.uuid4().hex,
+            'date': datetime.datetime.now().isoformat(),
+            'status': 'running',
+            'start': time.monotonic(),
+            'epochs': int(args.get('epochs', 3)),
+            'duration': float(args.get('duration', 5)),
+            }
+        trainings[job['uuid']] = job
+        return training_status(job)
+
+    @app.get('/v2/models/{name}/train/')
+    async def list_trainings(name: str):
+        return [training_status(job) for job in trainings.values()]
+
+    @app.get('/v2/models/{name}/train/{uuid}')
+    async def get_training(name: str, uuid: str):
+        if uuid not in trainings:
+            return JSONResponse({'message': 'Training not found'}, status_code=404)
+        return training_status(trainings[uuid])
+
+    @app.exception_handler(ValueError)
+    async def bad_request(request, exc):
+        return JSONResponse({'message': str(exc)}, status_code=400)
+
+    return app
+
+
+def start(port):
+    """
+    Launch the stub DEEPaaS in a separate process and wait until it is ready.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, 'stub_deepaas.py', '--port', str(port)],
+        cwd=Path(__file__).parent.absolute(),
+        )
+    for _ in range(100):
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/swagger.json')
+            return proc
+        except httpx.TransportError:
+            time.sleep(0.1)
+    proc.kill()
+    raise Exception("Stub DEEPaaS could not be launched")
+
+
+@click.command()
+@click.option('--port',
+              default=5000,
+              help='Port of the stub DEEPaaS API')
+@click.option('--spec',
+              default=None,
+              help='Path to a custom swagger.json to serve')
+def main(port, spec):
+    if spec:
+        with open(spec) as f:
+            spec = json.load(f)
+    uvicorn.run(create_app(spec), host='127.0.0.1', port=port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
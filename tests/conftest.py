@@ -0,0 +1,8 @@
+import os
+from pathlib import Path
+import sys
+import tempfile
+
+# Keep test outputs apart from the outputs of a running UI
+os.environ['OUTPUT_DIR'] = tempfile.mkdtemp(prefix='deepaas_ui_tests_')
+sys.path.insert(0, str(Path(__file__).parent.parent))
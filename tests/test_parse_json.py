@@ -0,0 +1,77 @@
+import base64
+import binascii
+import json
+import os
+
+import pytest
+
+import ui_utils
+
+
+def parse(obj_or_text, **kwargs):
+    text = obj_or_text if isinstance(obj_or_text, str) else json.dumps(obj_or_text)
+    return ui_utils.parse_json(text.encode('utf-8'), **kwargs)
+
+
+@pytest.mark.parametrize('obj', [
+    {},
+    {'a': 1, 'b': -2.5e3, 'c': True, 'd': None},
+    {'a': {'b': [1, {'c': ']'}, []]}, 'd': '}'},
+    {'a': [[[['deep']]]], 'b': {'c': {'d': {}}}},
+    {'a': 'quote " and backslash \\ and slash /', 'b': '\\"}'},
+    {'a': 'unicode é ✓', 'b': '\n\t'},
+    ])
+def test_same_as_json(obj):
+    assert parse(obj) == obj
+
+
+def test_whitespace():
+    assert parse(' \n{ "a" :\t[1 , 2] ,\r\n"b":{ } }\n') == {'a': [1, 2], 'b': {}}
+
+
+def test_not_an_object():
+    assert parse([1, {'a': 2}]) == [1, {'a': 2}]
+
+
+def test_skipped_keys():
+    obj = {'big': [{'x': '"]}'}] * 10, 'kept': {'y': 1}}
+    assert parse(obj, keys={'kept'}) == {'kept': {'y': 1}}
+
+
+@pytest.mark.parametrize('text', [
+    '{"a": 1',
+    '{"a": [1, 2',
+    '{"a": {"b": "c"}',
+    '{"a": "abc',
+    '{"a": "abc\\"}',
+    '{"a" 1}',
+    '{"a": 1 "b": 2}',
+    ])
+def test_truncated(text):
+    with pytest.raises(ValueError):
+        parse(text)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 7, 1024 ** 2])
+def test_media(monkeypatch, chunk_size):
+    monkeypatch.setattr(ui_utils, 'DOWNLOAD_CHUNK_SIZE', chunk_size)
+    data = os.urandom(1000)
+    rc = parse({'image': base64.b64encode(data).decode(), 'text': 'x'}, media=['image'])
+    with open(rc['image'], 'rb') as f:
+        assert f.read() == data
+    assert rc['text'] == 'x'
+
+
+def test_media_escaped():
+    data = os.urandom(300)
+    b64 = base64.b64encode(data).decode().replace('/', '\\/')
+    rc = parse('{"image": "%s"}' % b64, media=['image'])
+    with open(rc['image'], 'rb') as f:
+        assert f.read() == data
+
+
+def test_media_invalid():
+    before = set(os.listdir(ui_utils.OUTPUT_DIR))
+    with pytest.raises(binascii.Error):
+        parse({'image': 'abc'}, media=['image'])
+    assert set(os.listdir(ui_utils.OUTPUT_DIR)) == before
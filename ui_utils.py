@@ -14,29 +14,1362 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import base64
+import asyncio
+import binascii
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import importlib
 import inspect
+import io
 import json
 import mimetypes
+import mmap
 import os
 from pathlib import Path
+import random
 import re
-import requests
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+import types
+import urllib.parse
 import warnings
+import zipfile
 
 import gradio as gr
+import httpx
+import numpy as np
+from PIL import Image, ImageOps
+
+import metrics
 
 
 main_path = Path(__file__).parent.absolute()
 
-session = requests.Session()
+# Number of UI worker processes (see workers.py), and index of the current one
+# (empty in the main process). The limits of the predictions and the sizes of
+# the stores below are split among the workers, so their totals are kept.
+# There are no more workers than predictions allowed in flight (MAX_INFLIGHT),
+# as extra workers could never send any.
+UI_WORKERS = max(1, min(int(os.getenv('UI_WORKERS', 1)), int(os.getenv('MAX_INFLIGHT', 4))))
+UI_WORKER = os.getenv('UI_WORKER', '')
 
 
-def api2gr_inputs(api_inp):
+def worker_share(total):
+    # Part of a limit that belongs to the current worker (the remainder goes to
+    # the first workers)
+    k = int(UI_WORKER or 0)
+    return total // UI_WORKERS + (1 if k < total % UI_WORKERS else 0)
+
+
+# Connection pool and timeouts (in seconds) of the client used to call DEEPaaS.
+# The pool is shared by all the Gradio predictions, so one UI can keep many
+# predictions in flight while reusing a bounded number of connections.
+POOL_MAX_CONNECTIONS = int(os.getenv('POOL_MAX_CONNECTIONS', 100))
+POOL_MAX_KEEPALIVE = int(os.getenv('POOL_MAX_KEEPALIVE', 20))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv('POOL_KEEPALIVE_EXPIRY', 30))
+CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.getenv('READ_TIMEOUT', 600))  # inference can be slow
+
+# Size (in bytes) of the chunks in which uploaded files are read and sent
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+
+# Size (in bytes) of the chunks in which responses are downloaded, and max size
+# of the responses we accept from DEEPaaS
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+MAX_RESPONSE_SIZE = int(os.getenv('MAX_RESPONSE_SIZE', 1024 ** 3))
+
+# JSON responses bigger than this size (in bytes) are spooled to disk and parsed
+# from there, instead of being held in memory
+JSON_SPOOL_SIZE = int(os.getenv('JSON_SPOOL_SIZE', 1024 ** 2))
+
+# Decoder of the JSON responses: "auto" (first of orjson/simdjson installed,
+# otherwise the standard library), "orjson", "simdjson" or "json"
+JSON_DECODER = os.getenv('JSON_DECODER', 'auto')
+
+# Max number of predictions sent to DEEPaaS at the same time, and max number of
+# predictions waiting for their turn (further predictions are rejected)
+MAX_INFLIGHT = worker_share(int(os.getenv('MAX_INFLIGHT', 4)))
+MAX_QUEUE = worker_share(int(os.getenv('MAX_QUEUE', 32)))
+
+# Number of worker threads preprocessing the uploaded media (see the `#maxside`,
+# `#format` and `#maxduration` tags of the input descriptions)
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', os.cpu_count() or 1))
+
+# Replicas of DEEPaaS are ejected for some time (in seconds) after several
+# consecutive failures, and the list of replicas (when read from a file) and the
+# replicas that could not be verified are checked again periodically
+BACKEND_MAX_FAILURES = int(os.getenv('BACKEND_MAX_FAILURES', 3))
+BACKEND_EJECT_TIME = float(os.getenv('BACKEND_EJECT_TIME', 30))
+BACKEND_REFRESH_INTERVAL = float(os.getenv('BACKEND_REFRESH_INTERVAL', 10))
+
+# Responses that tell that the replica itself failed (other errors, eg. a 500
+# raised by the model on a bad input, say nothing about the replica health)
+BACKEND_FAILURE_STATUSES = [502, 503, 504]
+
+# Predictions that fail before reaching the model (connection errors, 502/503
+# responses) are retried up to RETRY_MAX times, with exponential backoff (in
+# seconds) and jitter. Slow predictions can be hedged: a duplicate call is sent
+# to another replica after HEDGE_AFTER seconds (0 to disable), and the first
+# one to finish wins.
+RETRY_MAX = int(os.getenv('RETRY_MAX', 2))
+RETRY_BACKOFF = float(os.getenv('RETRY_BACKOFF', 0.5))
+RETRY_STATUSES = [502, 503]
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+HEDGE_AFTER = float(os.getenv('HEDGE_AFTER', 0))
+
+# Lists in the outputs are shown truncated to this number of items (at each
+# level of nesting), the full outputs can be downloaded as a JSON file
+MAX_ARRAY_ITEMS = int(os.getenv('MAX_ARRAY_ITEMS', 100))
+
+# Max number of predictions of a batch that are sent to DEEPaaS at the same time
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 2))
+
+# Max number of files, and of uncompressed bytes, extracted from the zips of a batch
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 1000))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 1024 ** 3))
+
+# Number of the latest results of a batch shown in the UI (all of them are in
+# the results zip)
+BATCH_SHOWN = int(os.getenv('BATCH_SHOWN', 10))
+
+# Max time (in seconds) that a prediction waits to be coalesced with concurrent
+# ones into a single DEEPaaS call (see the `#batch` tag of the input descriptions)
+COALESCE_MAX_WAIT = float(os.getenv('COALESCE_MAX_WAIT', 0.02))
+
+# Prediction outputs (images, videos, etc) are saved in a dedicated folder that
+# is kept under a max size (in bytes) and where files expire after a TTL (in seconds)
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', os.path.join(tempfile.gettempdir(), 'deepaas_ui', 'outputs'))
+OUTPUT_MAX_SIZE = int(os.getenv('OUTPUT_MAX_SIZE', 2 * 1024 ** 3)) // UI_WORKERS
+if UI_WORKER:
+    OUTPUT_DIR = os.path.join(OUTPUT_DIR, f'worker-{UI_WORKER}')  # each worker manages its own files
+OUTPUT_TTL = float(os.getenv('OUTPUT_TTL', 3600))
+OUTPUT_SWEEP_INTERVAL = float(os.getenv('OUTPUT_SWEEP_INTERVAL', 60))
+
+# Opt-in cache of the predictions, with an in-memory tier and an optional on-disk
+# tier (enabled when a folder is provided). Sizes are in bytes.
+PREDICTION_CACHE = os.getenv('PREDICTION_CACHE', 'false').lower() in ['true', '1']
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', 64 * 1024 ** 2)) // UI_WORKERS
+PREDICTION_CACHE_DIR = os.getenv('PREDICTION_CACHE_DIR', '')  # shared by the workers
+PREDICTION_CACHE_DISK_SIZE = int(os.getenv('PREDICTION_CACHE_DISK_SIZE', 1024 ** 3)) // UI_WORKERS
+
+# Folder where the UI compiled from the DEEPaaS spec is cached, to skip the
+# discovery on restarts (share it among replicas to skip it on scale-out too)
+UI_CACHE_DIR = os.getenv('UI_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'deepaas_ui', 'ui_cache'))
+
+
+class OutputStore:
     """
-    Transform DEEPaaS webargs to Gradio inputs.
+    Folder where prediction outputs are saved.
+
+    Files are evicted in least-recently-used order when the folder exceeds
+    `max_size` bytes, and removed once they are older than `ttl` seconds.
+    Gradio copies the outputs to its own cache right after the prediction,
+    so evicted files are never needed again.
+    """
+
+    def __init__(self, path, max_size, ttl):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.files = collections.OrderedDict()  # {path: (size, last access)}, in LRU order
+        self.size = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+        # Keep track of the files left by previous runs
+        for f in sorted(self.path.iterdir(), key=lambda f: f.stat().st_mtime):
+            if f.is_file():
+                stat = f.stat()
+                self.files[str(f)] = (stat.st_size, stat.st_mtime)
+                self.size += stat.st_size
+
+    def tempfile(self, suffix=None):
+        """
+        Create a new file in the store. Register it with `add()` once written.
+        """
+        return tempfile.NamedTemporaryFile(dir=self.path, suffix=suffix, delete=False)
+
+    def add(self, path):
+        """
+        Register a file written in the store and evict old files if needed.
+        """
+        size = os.path.getsize(path)
+        with self.lock:
+            old_size, _ = self.files.pop(path, (0, None))
+            self.files[path] = (size, time.time())
+            self.size += size - old_size
+        self.evict(keep=path)
+
+    def touch(self, path):
+        """
+        Mark a file as recently used. Return False if the file is no longer stored.
+        """
+        with self.lock:
+            if path not in self.files or not os.path.exists(path):
+                return False
+            size, _ = self.files[path]
+            self.files[path] = (size, time.time())
+            self.files.move_to_end(path)
+            return True
+
+    def evict(self, keep=None):
+        """
+        Remove expired files, then least recently used files until the store
+        fits in its max size. The `keep` file is never removed.
+        """
+        now = time.time()
+        with self.lock:
+            for path, (size, atime) in list(self.files.items()):
+                expired = now - atime > self.ttl
+                if not expired and self.size <= self.max_size:
+                    break  # remaining files are more recent
+                if path == keep:
+                    continue
+                self.files.pop(path)
+                self.size -= size
+                self.evicted += 1
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def start_sweeper(self, interval):
+        """
+        Periodically evict files in a background thread.
+        """
+        def sweep():
+            while True:
+                time.sleep(interval)
+                self.evict()
+
+        if self.sweeper is None:
+            self.sweeper = threading.Thread(target=sweep, daemon=True)
+            self.sweeper.start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'bytes': self.size,
+                'max_bytes': self.max_size,
+                'evicted': self.evicted,
+                }
+
+
+output_store = OutputStore(OUTPUT_DIR, max_size=OUTPUT_MAX_SIZE, ttl=OUTPUT_TTL)
+
+
+
+class PredictionCache:
+    """
+    Cache of DEEPaaS predictions, keyed on the content of the uploaded files,
+    the params and the MIME of the call.
+
+    Entries live in an in-memory LRU tier and, optionally, in an on-disk LRU
+    tier that survives restarts. Output files referenced by an entry live in
+    the output store (memory tier) or are copied to the entry folder (disk tier).
+    """
+
+    def __init__(self, max_size, path='', disk_max_size=0):
+        self.max_size = max_size
+        self.memory = collections.OrderedDict()  # {key: (result, size)}
+        self.memory_size = 0
+
+        self.path = Path(path) if path else None
+        self.disk_max_size = disk_max_size
+        self.disk = collections.OrderedDict()  # {key: size}
+        self.disk_size = 0
+        if self.path:
+            self.path.mkdir(parents=True, exist_ok=True)
+            entries = [d for d in self.path.iterdir() if (d / 'result.json').exists()]
+            for d in sorted(entries, key=lambda d: d.stat().st_mtime):
+                size = sum(f.stat().st_size for f in d.iterdir())
+                self.disk[d.name] = size
+                self.disk_size += size
+
+        self.lock = threading.Lock()
+        self.hits = collections.Counter()  # by tier
+        self.misses = 0
+
+    @staticmethod
+    def _hash_files(files):
+        h = hashlib.sha256()
+        for name, path in sorted(files.items()):
+            h.update(name.encode('utf-8'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    async def key(self, url, mime, params, files):
+        """
+        Hash the inputs of a call. Files are hashed in a worker thread so we
+        don't block the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        files_hash = await loop.run_in_executor(None, self._hash_files, files)
+        call = json.dumps([url, mime, params, files_hash], sort_keys=True, default=str)
+        return hashlib.sha256(call.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _map_files(result, fn, files=None):
+        # Outputs are either a single value or a list of values, and output
+        # files are the values that point to the output store (or the given
+        # filenames, for disk entries)
+        def f(v):
+            if not isinstance(v, str):
+                return v
+            if (v in files) if files is not None else (Path(v).parent == output_store.path):
+                return fn(v)
+            return v
+        return [f(v) for v in result] if isinstance(result, list) else f(result)
+
+    async def get(self, key):
+        """
+        Return the cached prediction, or None if it is not cached. Disk entries
+        are read in a worker thread so we don't block the event loop.
+        """
+        with self.lock:
+            if key in self.memory:
+                result, _ = self.memory[key]
+                files = []
+                self._map_files(result, files.append)
+                if all(output_store.touch(p) for p in files):
+                    self.memory.move_to_end(key)
+                    self.hits['memory'] += 1
+                    return result
+                self._pop_memory(key)  # outputs were evicted
+
+            # Entries might have been added (or removed) by other workers
+            on_disk = key in self.disk or (self.path and (self.path / key / 'result.json').exists())
+
+        if on_disk:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(None, self._get_disk, key)
+            if result is not None:
+                return result
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _get_disk(self, key):
+        d = self.path / key
+
+        # Copy output files back to the output store
+        def restore(p):
+            with output_store.tempfile(suffix=Path(p).suffix) as fp:
+                with open(d / p, 'rb') as src:
+                    shutil.copyfileobj(src, fp)
+            output_store.add(fp.name)
+            return fp.name
+
+        try:
+            with open(d / 'result.json') as f:
+                entry = json.load(f)
+            result = self._map_files(entry['result'], restore, files=set(entry['files']))
+            size = sum(f.stat().st_size for f in d.iterdir())
+            os.utime(d)
+        except (OSError, ValueError, KeyError):
+            # Evicted meanwhile (or written by an incompatible version)
+            with self.lock:
+                self.disk_size -= self.disk.pop(key, 0)
+            return None
+
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = size
+                self.disk_size += size
+            self.disk.move_to_end(key)
+            self._put_memory(key, result)
+            self.hits['disk'] += 1
+        return result
+
+    async def put(self, key, result):
+        """
+        Add a prediction to the cache.
+        """
+        with self.lock:
+            self._put_memory(key, result)
+            on_disk = not self.path or key in self.disk
+        if not on_disk:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._put_disk, key, result)
+
+    def _put_memory(self, key, result):
+        size = len(json.dumps(result))
+        if size > self.max_size:
+            return
+        self._pop_memory(key)
+        self.memory[key] = (result, size)
+        self.memory_size += size
+        while self.memory_size > self.max_size:
+            self._pop_memory(next(iter(self.memory)))
+
+    def _pop_memory(self, key):
+        if key in self.memory:
+            _, size = self.memory.pop(key)
+            self.memory_size -= size
+
+    def _put_disk(self, key, result):
+        d = self.path / key
+        d.mkdir(exist_ok=True)
+
+        # Copy output files to the entry folder, and reference them by filename.
+        # Entries are plain JSON, so that a shared folder can't be used to
+        # inject code in the UI.
+        files = set()
+
+        def save(p):
+            shutil.copyfile(p, d / Path(p).name)
+            files.add(Path(p).name)
+            return Path(p).name
+
+        result = self._map_files(result, save)
+        with open(d / 'result.json.tmp', 'w') as f:
+            json.dump({'result': result, 'files': sorted(files)}, f)
+        os.replace(d / 'result.json.tmp', d / 'result.json')  # other workers only see complete entries
+
+        size = sum(f.stat().st_size for f in d.iterdir())
+        if size > self.disk_max_size:
+            shutil.rmtree(d, ignore_errors=True)
+            return
+
+        evicted = []
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = size
+                self.disk_size += size
+            while self.disk_size > self.disk_max_size:
+                old, old_size = self.disk.popitem(last=False)
+                self.disk_size -= old_size
+                evicted.append(old)
+        for old in evicted:
+            shutil.rmtree(self.path / old, ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits_memory': self.hits['memory'],
+                'hits_disk': self.hits['disk'],
+                'misses': self.misses,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_size,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_size,
+                }
+
+
+prediction_cache = PredictionCache(
+    max_size=PREDICTION_CACHE_SIZE,
+    path=PREDICTION_CACHE_DIR,
+    disk_max_size=PREDICTION_CACHE_DISK_SIZE,
+    )
+
+
+class AdmissionController:
+    """
+    Limit the number of predictions running at the same time in DEEPaaS.
+
+    Predictions over the limit wait in a bounded FIFO queue, and are rejected
+    right away when the queue is full. Waiting users are told their position
+    in the queue and an estimated waiting time.
+    """
+
+    def __init__(self, max_inflight, max_queue):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.inflight = 0
+        self.waiters = collections.deque()
+        self.latency = None  # moving average of the prediction time
+        self.admitted = 0
+        self.rejected = 0
+
+    def eta(self, position):
+        """
+        Estimated time (in seconds) until the prediction at `position` in the
+        queue is admitted.
+        """
+        if self.latency is None:
+            return None
+        return (position // self.max_inflight + 1) * self.latency
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.inflight < self.max_inflight and not self.waiters:
+            self.inflight += 1
+        elif len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Exception("The model is busy with other predictions, please try again in a few moments.")
+        else:
+            position = len(self.waiters)
+            eta = self.eta(position)
+            msg = f"Your prediction is queued in position {position + 1}"
+            if eta is not None:
+                msg += f" (estimated waiting time: {eta:.0f}s)"
+            gr.Info(msg)
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter  # the slot is handed to us by the finishing prediction
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()  # we were handed the slot, pass it on
+                else:
+                    self.waiters.remove(waiter)
+                raise
+
+        self.admitted += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            self._release()
+
+    def _release(self):
+        # Hand the slot to the next waiting prediction, if any
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.inflight -= 1
+
+    def stats(self):
+        return {
+            'inflight': self.inflight,
+            'queued': len(self.waiters),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            }
+
+
+admission = AdmissionController(max_inflight=MAX_INFLIGHT, max_queue=MAX_QUEUE)
+
+
+def spec_hash(specs):
+    # Hash of a DEEPaaS spec, to check that all the replicas serve the same one
+    return hashlib.sha256(json.dumps(specs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_backends(source):
+    """
+    Return the URLs of the DEEPaaS replicas in `source`: a comma-separated list
+    of URLs, or "@path" to read them from a file (one URL per line).
+    """
+    if source.startswith('@'):
+        with open(source[1:]) as f:
+            source = f.read().replace('\n', ',')
+    return [u.strip().rstrip('/') for u in source.split(',') if u.strip()]
+
+
+class Backends:
+    """
+    Replicas of DEEPaaS among which predictions are balanced.
+
+    Each prediction goes to the replica with the fewest outstanding requests
+    (in round-robin among ties). Replicas are checked passively, with a circuit
+    breaker: they are ejected for a while (open) after several consecutive
+    failures (connection errors or 502/503/504 responses), and then get a single trial
+    call at a time (half-open) until one succeeds (closed). While all the
+    replicas are ejected, the least recently ejected one gets a trial call and
+    other predictions fail fast (unless there is a single replica, which is
+    always tried). Only replicas whose
+    swagger.json matches the spec of the UI are used. If the replicas are read
+    from a file, the file is re-read when it changes.
+    """
+
+    def __init__(self, source, spec_hash=None, verified=()):
+        self.source = source
+        self.spec_hash = spec_hash
+        self.replicas = {}  # {url: state}
+        self.next = 0  # round-robin among ties
+        self.mtime = None
+        self.checked = 0
+        self.refreshing = False
+        self.update(verified=verified)
+
+    def update(self, verified=()):
+        # (Re)read the list of replicas
+        if self.source.startswith('@'):
+            try:
+                mtime = os.stat(self.source[1:]).st_mtime
+            except OSError as e:
+                warnings.warn(f"Replicas of DEEPaaS could not be read: {e}")
+                return
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+        urls = read_backends(self.source)
+        self.replicas = {
+            u: self.replicas.get(u) or {
+                'outstanding': 0,
+                'failures': 0,
+                'ejected_until': 0,
+                'verified': True if (u in verified or self.spec_hash is None) else None,
+                'verified_at': 0,
+                }
+            for u in urls
+            }
+        for u, r in self.replicas.items():
+            BACKEND_UP.set(int(bool(r['verified'])), backend=u)
+
+    async def verify(self, url, state):
+        # Check that the replica serves the same spec as the UI
+        state['verified_at'] = time.monotonic()
+        try:
+            r = await get_client().get(f'{url}/swagger.json', timeout=CONNECT_TIMEOUT)
+            r.raise_for_status()
+            state['verified'] = spec_hash(r.json()) == self.spec_hash
+            if not state['verified']:
+                warnings.warn(f"DEEPaaS replica {url} serves a different spec, it will not be used")
+        except (httpx.HTTPError, ValueError):
+            state['verified'] = None  # not ready yet, try again later
+        BACKEND_UP.set(int(bool(state['verified'])), backend=url)
+
+    async def refresh(self):
+        now = time.monotonic()
+        if self.refreshing or now - self.checked < BACKEND_REFRESH_INTERVAL:
+            return
+        self.refreshing, self.checked = True, now
+        try:
+            self.update()
+            await asyncio.gather(*[
+                self.verify(u, r) for u, r in list(self.replicas.items())
+                if not r['verified'] and now - r['verified_at'] >= BACKEND_REFRESH_INTERVAL
+                ])
+        finally:
+            self.refreshing = False
+
+    def healthy(self):
+        # Replicas that can take a call (closed circuit, or half-open without
+        # a trial call running)
+        now = time.monotonic()
+        return [
+            u for u, r in self.replicas.items()
+            if r['verified'] and r['ejected_until'] <= now
+            and not (r['failures'] >= BACKEND_MAX_FAILURES and r['outstanding'])
+            ]
+
+    def pick(self):
+        candidates = self.healthy()
+        if not candidates:
+            # A single replica is tried anyway, as there is nothing to fail over
+            # to. Otherwise the least recently ejected replica gets an early
+            # trial call, if it is not running one already.
+            verified = [u for u, r in self.replicas.items() if r['verified']]
+            idle = [u for u in verified if not self.replicas[u]['outstanding']]
+            if len(verified) == 1:
+                return verified[0]
+            if idle:
+                return min(idle, key=lambda u: self.replicas[u]['ejected_until'])
+            FAST_FAILS.inc()
+            raise Exception("No DEEPaaS replica is available, please try again in a few moments.")
+        self.next = (self.next + 1) % len(candidates)
+        candidates = candidates[self.next:] + candidates[:self.next]
+        return min(candidates, key=lambda u: self.replicas[u]['outstanding'])
+
+    @contextlib.asynccontextmanager
+    async def route(self, url):
+        """
+        Resolve `url` (relative to the replicas, or absolute) to a replica.
+        Mark `call.failed` if the call failed because of the replica.
+        """
+        call = types.SimpleNamespace(url=url, failed=False)
+        if urllib.parse.urlparse(url).scheme:
+            yield call  # absolute URL, nothing to balance
+            return
+
+        await self.refresh()
+        base = self.pick()
+        state = self.replicas[base]
+        call.url = base + url
+        if state['failures'] >= BACKEND_MAX_FAILURES:
+            BACKEND_CIRCUIT.set(2, backend=base)  # trial call
+        state['outstanding'] += 1
+        BACKEND_OUTSTANDING.set(state['outstanding'], backend=base)
+        try:
+            yield call
+        except httpx.TransportError:
+            call.failed = True
+            raise
+        finally:
+            state['outstanding'] -= 1
+            BACKEND_OUTSTANDING.set(state['outstanding'], backend=base)
+            if call.failed:
+                state['failures'] += 1
+                if state['failures'] >= BACKEND_MAX_FAILURES:
+                    # Failures are not reset, so that a single new failure
+                    # ejects the replica again after the ejection time
+                    state['ejected_until'] = time.monotonic() + BACKEND_EJECT_TIME
+                    BACKEND_EJECTIONS.inc(backend=base)
+                    BACKEND_CIRCUIT.set(1, backend=base)
+                    warnings.warn(f"DEEPaaS replica {base} ejected after {state['failures']} consecutive failures")
+            else:
+                state['failures'] = 0
+                BACKEND_CIRCUIT.set(0, backend=base)
+
+    def stats(self):
+        return {u: dict(r) for u, r in self.replicas.items()}
+
+
+backends = Backends('')  # replaced in launch.py
+
+
+def split_batch(rc, offset, count, total):
+    """
+    Return the part of a batched DEEPaaS output that belongs to the items at
+    `offset:offset+count` of the batch. Lists with one value per item are
+    sliced, other values are shared by all the items.
+    """
+    def split(v):
+        return v[offset:offset + count] if isinstance(v, list) and len(v) == total else v
+    if isinstance(rc, dict):
+        return {k: split(v) for k, v in rc.items()}
+    return split(rc)
+
+
+class Coalescer:
+    """
+    Coalesce concurrent predictions into batched DEEPaaS calls.
+
+    Predictions with the same batch `key` pile their items up while a batch of
+    that key is already running in DEEPaaS, and are sent together once the
+    batch is full, after `max_wait` seconds, or when the running batch ends.
+    When DEEPaaS is idle predictions are sent right away, so batching only
+    adds latency under load.
+    """
+
+    def __init__(self, max_wait):
+        self.max_wait = max_wait
+        self.pending = {}  # {key: batch being filled}
+        self.running = collections.Counter()  # {key: batches running in DEEPaaS}
+
+    async def submit(self, key, items, max_items, send):
+        """
+        Add the items of a prediction to the batch of `key` and return their
+        part of the output. `send(items)` makes the batched call.
+        """
+        loop = asyncio.get_running_loop()
+        batch = self.pending.get(key)
+        if batch is not None and len(batch.items) + len(items) > max_items:
+            self.flush(key, batch)
+            batch = None
+        if batch is None:
+            batch = types.SimpleNamespace(
+                items=[],
+                callers=[],  # (offset, count, future) of each prediction
+                send=send,
+                max_items=max_items,
+                created=time.perf_counter(),
+                )
+            batch.timer = loop.call_later(self.max_wait, self.flush, key, batch)
+            self.pending[key] = batch
+
+        future = loop.create_future()
+        batch.callers.append((len(batch.items), len(items), future))
+        batch.items.extend(items)
+        if len(batch.items) >= max_items or not self.running[key]:
+            self.flush(key, batch)
+        return await future
+
+    def flush(self, key, batch):
+        if self.pending.get(key) is not batch:
+            return  # already sent
+        del self.pending[key]
+        batch.timer.cancel()
+        self.running[key] += 1
+        asyncio.ensure_future(self._send(key, batch))
+
+    async def _send(self, key, batch):
+        module = Path(urllib.parse.urlparse(key[0]).path).parent.name
+        BATCH_ITEMS.observe(len(batch.items), module=module)
+        BATCH_MAX_ITEMS.set(batch.max_items, module=module)
+        BATCH_WAIT.observe(time.perf_counter() - batch.created, module=module)
+        try:
+            rc = await batch.send(batch.items)
+        except Exception as e:
+            for _, _, future in batch.callers:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for offset, count, future in batch.callers:
+                if not future.done():  # the user might have left
+                    future.set_result(split_batch(rc, offset, count, len(batch.items)))
+        finally:
+            self.running[key] -= 1
+
+        # The items piled up meanwhile don't need to wait any longer
+        if key in self.pending and not self.running[key]:
+            self.flush(key, self.pending[key])
+
+
+coalescer = Coalescer(max_wait=COALESCE_MAX_WAIT)
+
+
+
+# Metrics of the predictions (exposed in the /metrics endpoint)
+REQUESTS = metrics.Counter(
+    'deepaas_ui_requests_total',
+    'Predictions sent to DEEPaaS, by module and HTTP status ("error" if no response)',
+    )
+REQUEST_SECONDS = metrics.Histogram(
+    'deepaas_ui_request_seconds',
+    'Total time of the predictions, by module',
+    )
+STAGE_SECONDS = metrics.Histogram(
+    'deepaas_ui_stage_seconds',
+    'Time spent in each stage of the predictions (preprocess, queue, upload, inference, download, parse, decode, write), by module',
+    )
+REQUEST_BYTES = metrics.Counter(
+    'deepaas_ui_request_bytes_total',
+    'Bytes uploaded to DEEPaaS, by module',
+    )
+RESPONSE_BYTES = metrics.Counter(
+    'deepaas_ui_response_bytes_total',
+    'Bytes downloaded from DEEPaaS, by module',
+    )
+BACKEND_UP = metrics.Gauge(
+    'deepaas_ui_backend_up',
+    'Whether a DEEPaaS replica serves the spec of the UI (1) or not (0), by backend',
+    )
+BACKEND_OUTSTANDING = metrics.Gauge(
+    'deepaas_ui_backend_outstanding',
+    'Predictions running in each DEEPaaS replica, by backend',
+    )
+BACKEND_EJECTIONS = metrics.Counter(
+    'deepaas_ui_backend_ejections_total',
+    'Times a DEEPaaS replica was ejected because of consecutive failures, by backend',
+    )
+BACKEND_CIRCUIT = metrics.Gauge(
+    'deepaas_ui_backend_circuit',
+    'Circuit breaker of each DEEPaaS replica: closed (0), open (1) or half-open (2), by backend',
+    )
+FAST_FAILS = metrics.Counter(
+    'deepaas_ui_fast_fails_total',
+    'Predictions failed right away because no DEEPaaS replica was available',
+    )
+RETRIES = metrics.Counter(
+    'deepaas_ui_retries_total',
+    'Calls to DEEPaaS retried, by module and reason (error or HTTP status)',
+    )
+HEDGES = metrics.Counter(
+    'deepaas_ui_hedges_total',
+    'Slow calls to DEEPaaS hedged with a duplicate call, by module and winner (first or hedge)',
+    )
+BATCH_ITEMS = metrics.Histogram(
+    'deepaas_ui_batch_items',
+    'Items coalesced in each batched call to DEEPaaS, by module',
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256],
+    )
+BATCH_WAIT = metrics.Histogram(
+    'deepaas_ui_batch_wait_seconds',
+    'Time the first prediction of a batch waited for the batch to be sent, by module',
+    )
+BATCH_MAX_ITEMS = metrics.Gauge(
+    'deepaas_ui_batch_max_items',
+    'Max items coalesced in a batched call to DEEPaaS (`#batch` tag of the input), by module',
+    )
+metrics.Callback(
+    'deepaas_ui_batch_max_wait_seconds',
+    'Max time a prediction waits to be coalesced into a batch (COALESCE_MAX_WAIT)',
+    fn=lambda: COALESCE_MAX_WAIT,
+    )
+for name, description, stats, key, type in [
+        ('outputs_bytes', 'Size (in bytes) of the stored prediction outputs', output_store.stats, 'bytes', 'gauge'),
+        ('outputs_files', 'Number of stored prediction outputs', output_store.stats, 'files', 'gauge'),
+        ('outputs_evicted_total', 'Prediction outputs evicted from the store', output_store.stats, 'evicted', 'counter'),
+        ('cache_hits_memory_total', 'Predictions served from the in-memory cache', prediction_cache.stats, 'hits_memory', 'counter'),
+        ('cache_hits_disk_total', 'Predictions served from the on-disk cache', prediction_cache.stats, 'hits_disk', 'counter'),
+        ('cache_misses_total', 'Predictions not found in the cache', prediction_cache.stats, 'misses', 'counter'),
+        ('cache_memory_bytes', 'Size (in bytes) of the in-memory cache', prediction_cache.stats, 'memory_bytes', 'gauge'),
+        ('cache_disk_bytes', 'Size (in bytes) of the on-disk cache', prediction_cache.stats, 'disk_bytes', 'gauge'),
+        ('inflight', 'Predictions running in DEEPaaS', admission.stats, 'inflight', 'gauge'),
+        ('queued', 'Predictions waiting for their turn', admission.stats, 'queued', 'gauge'),
+        ('rejected_total', 'Predictions rejected because the queue was full', admission.stats, 'rejected', 'counter'),
+        ]:
+    metrics.Callback(
+        f'deepaas_ui_{name}',
+        description,
+        fn=lambda stats=stats, key=key: stats()[key],
+        type=type,
+        )
+
+
+_client = None
+
+
+def get_client():
+    """
+    Return the async client shared by all the calls to DEEPaaS.
+    It is created lazily so that it binds to the event loop run by Gradio.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            follow_redirects=True,  # as requests did (eg. DEEPaaS adds trailing slashes)
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+                ),
+            timeout=httpx.Timeout(
+                connect=CONNECT_TIMEOUT,
+                read=READ_TIMEOUT,
+                write=READ_TIMEOUT,
+                pool=READ_TIMEOUT,  # time waiting for a free connection of the pool
+                ),
+            )
+    return _client
+
+
+async def close_client():
+    """
+    Close the client shared by all the calls to DEEPaaS (eg. before leaving
+    the event loop it is bound to).
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+
+class MultipartStream:
+    """
+    Streaming multipart/form-data body for the files uploaded to DEEPaaS.
+
+    Files are read in chunks while the request is being sent, so memory usage
+    does not grow with the size of the uploads. Use it as a context manager
+    so that the files are closed as soon as the call is done.
+    """
+
+    def __init__(self, files: dict):
+        self.files = files  # {input name: file path}
+        self.boundary = os.urandom(16).hex()
+        self.handles = []
+        self.sent = None  # time at which the body was fully sent
+
+    @property
+    def headers(self):
+        return {
+            'Content-Type': f'multipart/form-data; boundary={self.boundary}',
+            'Content-Length': str(self.content_length),
+            }
+
+    def part_header(self, name, path):
+        # We try to provide the mimetype to the user whenever possible
+        mtype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        name = name.replace('"', '%22')
+        fname = Path(path).name.replace('"', '%22')
+        header = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"; filename="{fname}"\r\n'
+            f'Content-Type: {mtype}\r\n\r\n'
+            )
+        return header.encode('utf-8')
+
+    @property
+    def tail(self):
+        return f'--{self.boundary}--\r\n'.encode('utf-8')
+
+    @property
+    def content_length(self):
+        size = len(self.tail)
+        for name, path in self.files.items():
+            size += len(self.part_header(name, path)) + os.path.getsize(path) + 2
+        return size
+
+    def __enter__(self):
+        for path in self.files.values():
+            self.handles.append(open(path, 'rb'))
+        return self
+
+    def __exit__(self, *exc):
+        for f in self.handles:
+            f.close()
+        self.handles = []
+
+    async def __aiter__(self):
+        for (name, path), f in zip(self.files.items(), self.handles):
+            yield self.part_header(name, path)
+            f.seek(0)  # make the body replayable (eg. redirects)
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            yield b'\r\n'
+        yield self.tail
+        self.sent = time.perf_counter()
+
+
+
+async def iter_response(r):
+    """
+    Iterate over the body of a streamed DEEPaaS response, enforcing the max
+    response size.
+    """
+    msg = f"DEEPaaS response exceeds the max allowed size ({MAX_RESPONSE_SIZE} bytes)."
+    if int(r.headers.get('content-length', 0)) > MAX_RESPONSE_SIZE:
+        raise Exception(msg)
+    size = 0
+    async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_RESPONSE_SIZE:
+            raise Exception(msg)
+        yield chunk
+
+
+async def iter_lines(r):
+    """
+    Iterate over the lines of a streamed DEEPaaS response (eg. NDJSON) as soon
+    as they arrive. Empty lines are skipped. The max response size is enforced
+    on each line, as streams can last long.
+    """
+    buf = bytearray()
+    async for chunk in r.aiter_bytes():
+        start = len(buf)
+        buf += chunk
+        i = buf.find(b'\n', start)  # only search the new chunk
+        while i >= 0:
+            line = bytes(buf[:i])
+            del buf[:i + 1]
+            if line.strip():
+                yield line
+            i = buf.find(b'\n')
+        if len(buf) > MAX_RESPONSE_SIZE:
+            raise Exception(f"DEEPaaS response line exceeds the max allowed size ({MAX_RESPONSE_SIZE} bytes).")
+    if buf.strip():
+        yield bytes(buf)
+
+
+async def read_response(r):
+    """
+    Read the body of a streamed DEEPaaS response in memory.
+    """
+    return b''.join([chunk async for chunk in iter_response(r)])
+
+
+async def save_response(r, suffix=None, timings=None):
+    """
+    Write the body of a streamed DEEPaaS response to a file, chunk by chunk.
+    Return the path of the file.
+    """
+    timings = timings or metrics.StageTimer()
+    with output_store.tempfile(suffix=suffix) as fp:
+        try:
+            async for chunk in iter_response(r):
+                with timings('write'):
+                    fp.write(chunk)
+        except BaseException:
+            os.remove(fp.name)
+            raise
+    output_store.add(fp.name)
+    return fp.name
+
+
+async def spool_response(r):
+    """
+    Read the body of a streamed DEEPaaS response in memory if it is small,
+    otherwise write it to a temporary file. Return the file object.
+    """
+    fp = io.BytesIO()
+    async for chunk in iter_response(r):
+        if isinstance(fp, io.BytesIO) and fp.tell() + len(chunk) > JSON_SPOOL_SIZE:
+            tmp = tempfile.TemporaryFile()
+            tmp.write(fp.getvalue())
+            fp = tmp
+        fp.write(chunk)
+    return fp
+
+
+@contextlib.contextmanager
+def map_body(fp):
+    """
+    Give access to a spooled body as a bytes-like object, without reading it
+    in memory if it was written to disk.
+    """
+    if isinstance(fp, io.BytesIO):
+        yield fp.getvalue()
+    elif fp.tell() == 0:
+        yield b''  # empty files cannot be mapped
+    else:
+        fp.flush()
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+
+_JSON_WS = re.compile(rb'[ \t\n\r]*')
+_JSON_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_JSON_SPECIAL = re.compile(rb'[\[\]{}"]')
+_JSON_SCALAR = re.compile(rb'[^,}\]\s]+')
+
+
+def get_json_loads(name):
+    """
+    Return the `loads` function of the JSON decoder. Fast decoders are optional,
+    we fall back to the standard library if they are not installed.
+    """
+    for module in ['orjson', 'simdjson'] if name == 'auto' else [name]:
+        if module == 'json':
+            break
+        try:
+            fast_loads = importlib.import_module(module).loads
+        except ImportError:
+            if name != 'auto':
+                warnings.warn(f"JSON decoder {module} is not installed, falling back to the standard library")
+            continue
+
+        def loads(s):
+            try:
+                return fast_loads(s)
+            except ValueError:
+                return json.loads(s)  # eg. NaN, which is not valid JSON but is accepted by Python
+        return loads
+    return json.loads
+
+
+json_loads = get_json_loads(JSON_DECODER)
+
+
+def _json_string_end(buf, i):
+    # Fast path: strings without escaped chars (eg. base64) end at next quote
+    j = buf.find(b'"', i + 1)
+    if j != -1 and buf.find(b'\\', i + 1, j) == -1:
+        return j + 1
+    m = _JSON_STRING.match(buf, i)
+    if m is None:
+        raise ValueError(f"Unterminated JSON string at position {i}")
+    return m.end()
+
+
+def _json_value_end(buf, i):
+    # Find where the JSON value starting at position `i` ends, without decoding it
+    c = buf[i:i+1]
+    if c == b'"':
+        return _json_string_end(buf, i)
+    if c in (b'[', b'{'):
+        depth = 0
+        while True:
+            m = _JSON_SPECIAL.search(buf, i)
+            if m is None:
+                raise ValueError(f"Unterminated JSON value at position {i}")
+            i = m.start()
+            c = buf[i:i+1]
+            if c == b'"':
+                i = _json_string_end(buf, i)
+                continue
+            depth += 1 if c in (b'[', b'{') else -1
+            i += 1
+            if depth == 0:
+                return i
+    m = _JSON_SCALAR.match(buf, i)
+    if m is None:
+        raise ValueError(f"Invalid JSON value at position {i}")
+    return m.end()
+
+
+def decode_base64(buf, start, end, timings=None):
+    """
+    Decode the base64 string located at buf[start:end] straight into a file of
+    the output store, chunk by chunk. Return the path of the file.
+    """
+    timings = timings or metrics.StageTimer()
+    with output_store.tempfile() as fp:
+        try:
+            if buf.find(b'\\', start, end) != -1:
+                # Escaped chars (eg. "\/"), so we need a proper JSON decoding
+                with timings('decode'):
+                    media = binascii.a2b_base64(json_loads(bytes(buf[start-1:end+1])))
+                with timings('write'):
+                    fp.write(media)
+            else:
+                chunk_size = max(DOWNLOAD_CHUNK_SIZE // 4 * 4, 4)  # base64 works in blocks of 4 chars
+                with memoryview(buf) as mv:
+                    for k in range(start, end, chunk_size):
+                        with timings('decode'):
+                            media = binascii.a2b_base64(mv[k:min(k + chunk_size, end)])
+                        with timings('write'):
+                            fp.write(media)
+        except BaseException:
+            os.remove(fp.name)
+            raise
+    output_store.add(fp.name)
+    return fp.name
+
+
+def parse_json(buf, media=(), keys=None, timings=None):
+    """
+    Parse a JSON response, decoding the base64 strings of the `media` keys
+    straight into files (the parsed value is then the file path).
+    Other values are decoded from their own slice of the body, so the body
+    itself is never copied. If `keys` are given, the values of other keys are
+    skipped without being decoded.
+    """
+    i = _JSON_WS.match(buf, 0).end()
+    if buf[i:i+1] != b'{':
+        return json_loads(bytes(buf))  # not an object, so no media to decode
+
+    rc = {}
+    i = _JSON_WS.match(buf, i + 1).end()
+    if buf[i:i+1] == b'}':
+        return rc
+    while True:
+        j = _json_string_end(buf, i)
+        key = json_loads(buf[i:j])
+        i = _JSON_WS.match(buf, j).end()
+        if buf[i:i+1] != b':':
+            raise ValueError(f"Expected ':' in JSON at position {i}")
+        i = _JSON_WS.match(buf, i + 1).end()
+        j = _json_value_end(buf, i)
+        if key in media and buf[i:i+1] == b'"':
+            rc[key] = decode_base64(buf, i + 1, j - 1, timings)
+        elif keys is None or key in keys:
+            rc[key] = json_loads(buf[i:j])
+        i = _JSON_WS.match(buf, j).end()
+        c = buf[i:i+1]
+        if c == b'}':
+            return rc
+        if c != b',':
+            raise ValueError(f"Expected ',' or '}}' in JSON at position {i}")
+        i = _JSON_WS.match(buf, i + 1).end()
+
+
+_TAG = re.compile(r'#(\w+)=(\S+)')
+
+preprocess_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=PREPROCESS_WORKERS,
+    thread_name_prefix='preprocess',
+    )
+
+
+def parse_tags(desc):
+    """
+    Parse the `#key=value` tags of an input description.
+    """
+    return {k.lower(): v.lower() for k, v in _TAG.findall(desc)}
+
+
+def input_media(i):
+    """
+    Media type (image, audio, video) of a file input, following the same rules
+    as `compile_inputs`. None if it is a generic file.
+    """
+    desc = i.get('description', '').lower()
+    filetypes = [ftype for ftype in ['image', 'audio', 'video'] if ftype in desc]
+    if len(filetypes) != 1 or '#noparse' in desc:
+        return None
+    return filetypes[0]
+
+
+def preprocess_media(path, media, tags, folder):
+    """
+    Downscale (`#maxside`), re-encode (`#format`) and trim (`#maxduration`) a
+    media file. Return the path of the new file, or the original path if
+    nothing had to be done or the preprocessing failed.
+    """
+    fmt = tags.get('format', Path(path).suffix.lstrip('.').lower())
+    out = os.path.join(folder, f'{Path(path).stem}.{fmt}')
+    try:
+        maxside = int(tags.get('maxside', 0))
+        os.makedirs(folder, exist_ok=True)
+        if media == 'image':
+            with Image.open(path) as im:
+                resize = maxside and max(im.size) > maxside
+                if not resize and f'.{fmt}' in Image.registered_extensions() \
+                        and Image.registered_extensions()[f'.{fmt}'] == im.format:
+                    return path  # already small enough, and in the right format
+                im = ImageOps.exif_transpose(im)  # the orientation is lost when re-encoding
+                if resize:
+                    im.thumbnail((maxside, maxside), Image.LANCZOS)
+                if fmt in ['jpg', 'jpeg'] and im.mode not in ['RGB', 'L']:
+                    im = im.convert('RGB')
+                im.save(out, quality=90)
+        else:
+            cmd = ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', path]
+            if 'maxduration' in tags:
+                cmd += ['-t', tags['maxduration']]
+            if media == 'video' and maxside:
+                cmd += ['-vf', (
+                    f"scale='min({maxside},iw)':'min({maxside},ih)'"
+                    ":force_original_aspect_ratio=decrease:force_divisible_by=2"
+                    )]
+            elif out.endswith(Path(path).suffix.lower()):
+                cmd += ['-c', 'copy']  # only trimming, no need to transcode
+            cmd.append(out)
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        warnings.warn(f"Preprocessing of {path} failed, sending the original file: {e}")
+        return path
+    return out
+
+
+async def preprocess_files(files, plan):
+    """
+    Preprocess the uploaded media whose inputs have preprocessing tags, in the
+    worker pool. Return the new files and the temporary folder where they were
+    saved (None if nothing was preprocessed).
+    """
+    jobs = {
+        i.name: (i.media, i.tags) for i in plan.inputs
+        if i.name in files and i.media and i.tags.keys() & {'maxside', 'format', 'maxduration'}
+        }
+    if not jobs:
+        return files, None
+
+    tmpdir = tempfile.mkdtemp(prefix='deepaas_ui_preprocess_')
+    loop = asyncio.get_running_loop()
+    try:
+        paths = await asyncio.gather(*[
+            loop.run_in_executor(
+                preprocess_pool,
+                preprocess_media,
+                files[name],
+                media,
+                tags,
+                os.path.join(tmpdir, name),  # one folder per input, to avoid name clashes
+                )
+            for name, (media, tags) in jobs.items()
+            ])
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return dict(files, **dict(zip(jobs, paths))), tmpdir
+
+
+def component(name, **kwargs):
+    """
+    Descriptor of a Gradio component. Unlike components, descriptors can be
+    serialized (see the UI cache in launch.py).
+    """
+    return {'component': name, 'kwargs': kwargs}
+
+
+def build_components(descriptors):
+    """
+    Build the Gradio components from their descriptors (a single descriptor or
+    a list of them).
+    """
+    if isinstance(descriptors, dict):
+        return getattr(gr, descriptors['component'])(**descriptors['kwargs'])
+    return [build_components(d) for d in descriptors]
+
+
+def compile_inputs(api_inp):
+    """
+    Transform DEEPaaS webargs to descriptors of Gradio inputs.
     """
     gr_inp = []
     for i in api_inp:
@@ -46,9 +1379,12 @@ def api2gr_inputs(api_inp):
             continue
 
         info = i.get('description', '').split('\n\n')[0]  # the split('\n\n') is used to remove the HTML code that Swagger adds automatically
+        if i['type'] != 'file':
+            info = _TAG.sub('', info).strip()  # remove the tags (eg. `#batch`), if present
 
         if 'enum' in i.keys():  # could also be gr.Radio()
-            tmp = gr.Dropdown(
+            tmp = component(
+                'Dropdown',
                 choices=i['enum'],
                 value=i.get('default', i['enum'][0]),
                 label=i['name'],
@@ -56,7 +1392,8 @@ def api2gr_inputs(api_inp):
                 )
         elif i['type'] in ['integer', 'number']:
             if (i['type'] == 'integer') and {'minimum', 'maximum'}.issubset(i.keys()):
-                tmp = gr.Slider(
+                tmp = component(
+                    'Slider',
                     value=i.get('default', None),
                     minimum=i.get('minimum', None),
                     maximum=i.get('maximum', None),
@@ -65,27 +1402,31 @@ def api2gr_inputs(api_inp):
                     info=info,
                     )
             else:
-                tmp = gr.Number(
+                tmp = component(
+                    'Number',
                     value=i.get('default', None),
                     label=i['name'],
                     info=info,
                     )
         elif i['type'] in ['boolean']:
-            tmp = gr.Checkbox(
+            tmp = component(
+                'Checkbox',
                 value=i.get('default', None),
                 label=i['name'],
                 info=info,
                 )
         elif i['type'] in ['string']:
             type = 'password' if i.get('format') == 'password' else 'text'
-            tmp = gr.Textbox(
+            tmp = component(
+                'Textbox',
                 value=i.get('default', None),
                 label=i['name'],
                 info=info,
                 type=type,
                 )
         elif i['type'] in ['array']:
-            tmp = gr.Textbox(
+            tmp = component(
+                'Textbox',
                 value=i.get('default', None),
                 label=i['name'],
                 info=info,
@@ -100,21 +1441,25 @@ def api2gr_inputs(api_inp):
             # * If user explicitly disables parsing
             cond2 = '#noparse' in desc
             if cond1 or cond2:
-                tmp = gr.File(
+                tmp = component(
+                    'File',
                     label=i['name'],
                     )
             elif 'image' in desc:
-                tmp = gr.Image(
+                tmp = component(
+                    'Image',
                     type='filepath',
                     label=i['name'],
                     )
             elif 'audio' in desc:
-                tmp = gr.Audio(
+                tmp = component(
+                    'Audio',
                     type='filepath',
                     label=i['name'],
                     )
             elif 'video' in desc:
-                tmp = gr.Video(
+                tmp = component(
+                    'Video',
                     label=i['name'],
                     )
             else:
@@ -124,7 +1469,8 @@ def api2gr_inputs(api_inp):
                     You should include the media type in the `{i['name']}` arg description for nice Gradio rendering.
                     Supported media types: image, video, audio.
                     """)
-                tmp = gr.File(
+                tmp = component(
+                    'File',
                     label=i['name'],
                     )
 
@@ -137,8 +1483,9 @@ def api2gr_inputs(api_inp):
         # In case of files, the info field is not supported, so we have to add it
         # as an additional HTML component
         if i['type'] == 'file':
-            info = info.replace('#noparse', '')  # remove the noparse keyword, if present
-            tmp = gr.HTML(
+            info = _TAG.sub('', info.replace('#noparse', ''))  # remove the noparse keyword and the tags, if present
+            tmp = component(
+                'HTML',
                 value=f'<p style="color: Gray;">{info}</p>',
                 label=f"{i['name']}-info",
             )
@@ -147,9 +1494,9 @@ def api2gr_inputs(api_inp):
     return gr_inp
 
 
-def api2gr_outputs(api_out):
+def compile_outputs(api_out):
     """
-    Transform DEEPaaS webargs to Gradio outputs.
+    Transform DEEPaaS webargs to descriptors of Gradio outputs.
     """
     gr_out = []
     for k, v in api_out.items():
@@ -158,7 +1505,8 @@ def api2gr_outputs(api_out):
         # categories (eg. dict of dicts)
         # In those cases return a string with the value
         if 'type' not in v:
-            tmp = gr.Textbox(
+            tmp = component(
+                'Textbox',
                 type='text',
                 label=k,
                 )
@@ -178,53 +1526,74 @@ def api2gr_outputs(api_out):
             # * If user explicitly disables parsing
             cond2 = '#noparse' in desc
             if cond1 or cond2:
-                tmp = gr.Textbox(
+                tmp = component(
+                    'Textbox',
                     type='text',
                     label=k,
                     )
             elif 'image' in desc:
-                tmp = gr.Image(
+                tmp = component(
+                    'Image',
                     type='filepath',
                     label=k,
                     )
             elif 'audio' in desc:
-                tmp = gr.Audio(
+                tmp = component(
+                    'Audio',
                     type='filepath',
                     label=k,
                     )
             elif 'video' in desc:
-                tmp = gr.Video(
+                tmp = component(
+                    'Video',
                     label=k,
                     )
 
             # Otherwise return normal string
             else:
                 type = 'password' if v.get('format') == 'password' else 'text'
-                tmp = gr.Textbox(
+                tmp = component(
+                    'Textbox',
                     type=type,
                     label=k,
                     )
 
         elif v['type'] in ['integer', 'number']:
-            tmp = gr.Number(
+            tmp = component(
+                'Number',
                 label=k,
                 )
         elif v['type'] in ['array']:
-            tmp = gr.Textbox(
+            tmp = component(
+                'Textbox',
                 label=k,
                 )
         elif v['type'] in ['object']:
-            tmp = gr.JSON(label=k)
+            tmp = component('JSON', label=k)
         else:
             raise Exception(f"UI does not support some of the output data types: {k} [{v['type']}]")
 
         gr_out.append(tmp)
 
+    # Big arrays are truncated in the UI, so offer the full outputs as a file
+    # (classification labels/probabilities are shown as top classes instead)
+    if any(
+        'type' not in v or v['type'] in ['array', 'object']
+        for k, v in api_out.items() if k not in ['labels', 'probabilities']
+        ):
+        gr_out.append(
+            component(
+                'File',
+                label='full outputs',
+                )
+            )
+
     # Interpret 'labels'/'predictions' keys as classification
     # FIXME: this hardcoded approach should be deprecated with DEEPaaS V3 (¿in favour of custom types?)
     # --> maybe can be fixed using 'description' in marshmallow fields
     if {'labels', 'probabilities'}.issubset(api_out.keys()):
-        tmp = gr.Label(
+        tmp = component(
+            'Label',
             num_top_classes=5,
             label='classification scores',
             )
@@ -233,51 +1602,386 @@ def api2gr_outputs(api_out):
     return gr_out
 
 
-def api_call(
+def api2gr_inputs(api_inp):
+    """
+    Transform DEEPaaS webargs to Gradio inputs.
+    """
+    return build_components(compile_inputs(api_inp))
+
+
+def api2gr_outputs(api_out):
+    """
+    Transform DEEPaaS webargs to Gradio outputs.
+    """
+    return build_components(compile_outputs(api_out))
+
+
+def ui_cache_key(specs):
+    """
+    Hash of the DEEPaaS spec. The code that compiles the spec is hashed too, so
+    that updating the UI also invalidates the cache.
+    """
+    h = hashlib.sha256()
+    for f in ['launch.py', 'ui_utils.py']:
+        h.update((main_path / f).read_bytes())
+    h.update(json.dumps(specs, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_ui_cache(key):
+    """
+    Return the compiled UI cached for `key`, or None if missing.
+    """
+    try:
+        with open(os.path.join(UI_CACHE_DIR, f'{key}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_ui_cache(key, ui):
+    """
+    Cache the compiled UI, replacing the outdated ones.
+    """
+    try:
+        os.makedirs(UI_CACHE_DIR, exist_ok=True)
+        path = os.path.join(UI_CACHE_DIR, f'{key}.json')
+        with tempfile.NamedTemporaryFile('w', dir=UI_CACHE_DIR, suffix='.tmp', delete=False) as f:
+            json.dump(ui, f)
+        os.replace(f.name, path)  # atomic, replicas might be writing at the same time
+        for old in Path(UI_CACHE_DIR).glob('*.json'):
+            if old.name != f'{key}.json':
+                old.unlink(missing_ok=True)
+    except OSError as e:
+        warnings.warn(f"The UI could not be cached: {e}")
+
+
+def _to_array(v):
+    # Arrays are introduced as comma-separated values in Gradio
+    return json.loads(f'[{v}]') if isinstance(v, str) else v
+
+
+class InputPlan:
+    """
+    How a Gradio input arg is sent to DEEPaaS.
+    """
+    __slots__ = ('index', 'name', 'convert', 'is_file', 'media', 'tags')
+
+    def __init__(self, index, name, convert=None, is_file=False, media=None, tags=None):
+        self.index = index  # position in the Gradio args
+        self.name = name  # DEEPaaS arg
+        self.convert = convert  # Gradio value -> DEEPaaS value
+        self.is_file = is_file  # sent as file, otherwise as param
+        self.media = media  # media type of files (see `input_media`)
+        self.tags = tags or {}  # tags of the description (see `preprocess_media` and `Coalescer`)
+
+
+class RequestPlan:
+    """
+    Mapping of the Gradio input args to the params/files of a DEEPaaS call,
+    compiled once from the DEEPaaS webargs so that calls just execute it.
+    It follows the layout of `compile_inputs`: the "accept" arg is not shown,
+    and an info gr.HTML() component comes after each file.
+    """
+    __slots__ = ('inputs', 'file_slot', 'batch')
+
+    def __init__(self, api_inp):
+        inputs = []
+        index = 0
+        for i in api_inp:
+            if i['name'] == 'accept':
+                continue
+            is_file = i['type'] == 'file'
+            inputs.append(
+                InputPlan(
+                    index=index,
+                    name=i['name'],
+                    convert={'integer': int, 'array': _to_array}.get(i['type']),
+                    is_file=is_file,
+                    media=input_media(i) if is_file else None,
+                    tags=parse_tags(i.get('description', '')),
+                    )
+                )
+            index += 2 if is_file else 1  # skip the info component of files
+        self.inputs = tuple(inputs)
+        self.file_slot = next((i.index for i in inputs if i.is_file), None)  # first file input
+
+        # Array input whose items can be coalesced with the ones of concurrent
+        # predictions, tagged with `#batch=<max items>`
+        self.batch = next((i for i in inputs if i.convert is _to_array and 'batch' in i.tags), None)
+
+    def __call__(self, user_args):
+        """
+        Return the params/files of the DEEPaaS call.
+        """
+        params, files = {}, {}
+        for i in self.inputs:
+            v = user_args[i.index]
+
+            # If parameter is empty, don't send anything otherwise the call will fail
+            # Add condition for booleans, otherwise v=False wasn't being sent
+            if not v and not isinstance(v, bool):
+                continue
+            if i.convert is not None:
+                v = i.convert(v)
+            if i.is_file:
+                files[i.name] = v
+            else:
+                params[i.name] = v
+        return params, files
+
+
+def truncate(value, max_items):
+    """
+    Return the JSON value with its lists truncated to `max_items` (plus a
+    note with their length), or the value itself if nothing was truncated.
+    """
+    if isinstance(value, list):
+        items = [truncate(v, max_items) for v in value[:max_items]]
+        if len(value) > max_items:
+            return items + [f'... ({len(value)} items)']
+        return value if all(a is b for a, b in zip(items, value)) else items
+    if isinstance(value, dict):
+        items = {k: truncate(v, max_items) for k, v in value.items()}
+        return value if all(items[k] is v for k, v in value.items()) else items
+    return value
+
+
+def format_outputs(rc, gr_out, schema, final=True):
+    """
+    Transform a JSON output of DEEPaaS to Gradio-friendly format. Partial
+    outputs (`final=False`, eg. NDJSON lines) might lack some values, and
+    their full values (if truncated) are not saved.
+    """
+
+    # This is probably not very general, only seems implemented in image-classification-tf
+    # (and related modules)  --> remove at some point
+    if rc.get('status', '') == 'error':
+        raise Exception(rc['message'])
+
+    # If no schema provided return everything as a JSON
+    if not schema:
+        return rc['predictions']
+
+    # If schema is provided, reorder outputs in Gradio's expected order
+    # and format outputs (if needed)
+    rout = []
+    truncated = {}  # full value of the truncated outputs
+    for arg in gr_out:
+        label = arg.label
+
+        # Even if defined in schema, modules don't return the value.
+        # Swagger does not complain, nor shouldn't we
+        value = rc.get(label, None)
+
+        # Handle classification outputs
+        # Only the top classes shown by Gradio are selected (and sorted), so
+        # that models with many classes don't send them all to the browser
+        if label == 'classification scores':
+            if 'probabilities' not in rc or 'labels' not in rc:
+                rout.append(None)  # not arrived yet (partial output)
+                continue
+            scores = np.asarray(rc['probabilities'], dtype=float)
+            k = min(arg.num_top_classes or len(scores), len(scores))
+            top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind='stable')].tolist()
+            rout.append({rc['labels'][i]: float(scores[i]) for i in top})
+
+        # Filled below, if any output is truncated
+        elif label == 'full outputs':
+            rout.append(None)
+
+        # Media files have already been decoded to file: return path
+        elif isinstance(arg, (gr.Image, gr.Audio, gr.Video)):
+            rout.append(value)
+
+        # Make sure generic "webargs.Field" params are strings
+        elif isinstance(arg, gr.Textbox) and arg.type=='str':
+            rout.append(str(value))
+
+        else:
+            short = truncate(value, MAX_ARRAY_ITEMS)
+            if short is not value:
+                truncated[label] = value
+            rout.append(short)
+
+    if truncated and final:
+        with output_store.tempfile(suffix='.json') as fp:
+            fp.write(json.dumps(truncated).encode('utf-8'))
+        output_store.add(fp.name)
+        labels = [arg.label for arg in gr_out]
+        if 'full outputs' in labels:
+            rout[labels.index('full outputs')] = fp.name
+
+    return rout
+
+
+def media_labels(gr_out, schema):
+    # Outputs whose base64 values are decoded straight to files
+    if not schema:
+        return []
+    return [arg.label for arg in gr_out if isinstance(arg, (gr.Image, gr.Audio, gr.Video))]
+
+
+def output_keys(gr_out, schema):
+    # Keys of the response that are rendered, the others are not decoded
+    keys = {'status', 'message'}  # errors
+    if not schema:
+        return keys | {'predictions'}
+    for arg in gr_out:
+        keys.add(arg.label)
+    if 'classification scores' in keys:
+        keys |= {'labels', 'probabilities'}
+    return keys
+
+
+async def hedged_call(attempt, url, module):
+    """
+    Run a DEEPaaS call, `attempt()`, and if it takes longer than HEDGE_AFTER
+    seconds, a duplicate of it (on another replica, if there is room for it).
+    Return the first one that succeeds, and cancel the other.
+    """
+    tasks = {asyncio.ensure_future(attempt()): 'first'}
+    try:
+        done, _ = await asyncio.wait(list(tasks), timeout=HEDGE_AFTER)
+        if (
+            not done
+            and not urllib.parse.urlparse(url).scheme
+            and len(backends.healthy()) > 1
+            and admission.inflight < admission.max_inflight
+            ):
+            tasks[asyncio.ensure_future(attempt())] = 'hedge'
+
+        def succeeded(task):
+            return task.exception() is None and task.result()[0].status_code < 500
+
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=succeeded, reverse=True):
+                if succeeded(task) or not pending:
+                    if len(tasks) > 1:
+                        HEDGES.inc(module=module, winner=tasks[task])
+                    return task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def resilient_call(attempt, url, module):
+    """
+    Run a DEEPaaS call, `attempt()`, which returns a tuple whose first item is
+    the response. Calls that did not reach the model (connection errors, 502/503
+    responses) are retried with exponential backoff and full jitter. Slow calls
+    are hedged, if enabled.
+    """
+    for k in range(RETRY_MAX + 1):
+        try:
+            rc = await (hedged_call(attempt, url, module) if HEDGE_AFTER else attempt())
+        except RETRY_ERRORS as e:
+            if k == RETRY_MAX:
+                raise
+            reason = e.__class__.__name__
+        else:
+            if rc[0].status_code not in RETRY_STATUSES or k == RETRY_MAX:
+                return rc
+            reason = str(rc[0].status_code)
+        RETRIES.inc(module=module, reason=reason)
+        await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** k))
+
+
+class TrafficRecorder:
+    """
+    Log of the predictions, one JSON line per call. Only their shapes are
+    logged (sizes of inputs, numeric/boolean params, MIME, timings), not the
+    user data.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, 'a', buffering=1)  # appends of whole lines are not mixed among workers
+
+    @staticmethod
+    def shape(value):
+        """
+        Anonymized shape of a param.
+        """
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return {'items': len(value)}
+        return {'len': len(str(value))}
+
+    @staticmethod
+    def file_shape(path):
+        """
+        Anonymized shape of an uploaded file.
+        """
+        return {'bytes': os.path.getsize(path), 'ext': Path(path).suffix.lower()}
+
+    def record(self, **entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+
+
+recorder = None  # set in launch.py, if the traffic is logged
+
+
+def recorded(func):
+    """
+    Log the calls of a prediction function to the traffic recorder, if any.
+    The function takes the DEEPaaS params and files mapped from the user args.
+    """
+    @functools.wraps(func)
+    async def wrapper(params, files, *, url, mime, **kwargs):
+        if recorder is None:
+            return await func(params, files, url=url, mime=mime, **kwargs)
+
+        # Shapes are taken before the call, which might change the params and files
+        entry = dict(
+            t=round(time.time(), 3),
+            module=Path(urllib.parse.urlparse(url).path).parent.name,
+            url=urllib.parse.urlparse(url).path,
+            mime=mime,
+            params={k: recorder.shape(v) for k, v in params.items()},
+            files={k: recorder.file_shape(v) for k, v in files.items()},
+            )
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            rout = await func(params, files, url=url, mime=mime, **kwargs)
+            status = 'ok'
+            return rout
+        finally:
+            recorder.record(**entry, status=status, seconds=round(time.perf_counter() - start, 4))
+
+    return wrapper
+
+
+async def api_call(
     *user_args: tuple,  # Gradio input args, introduced by user
-    api_inp: list,  # input args expected by DEEPaaS
+    plan: RequestPlan,  # mapping of the Gradio args to the DEEPaaS args
     gr_out: list, # output args expected by DEEPaaS
-    url: str,  # DEEPaaS predict endpoint
+    url: str,  # DEEPaaS predict endpoint (relative to the DEEPaaS replicas, or absolute)
     mime: str,  # MIME of the call
     schema: bool,  # whether the module has defined a schema for output validation
+    cache: bool = True,  # whether the predictions can be cached (ie. deterministic module)
     ):
 
-    # Remove the info gr.HTML() components that come after files (ugly but unavoidable)
-    # Otherwise the info is passed to deepaas
-    user_args = list(user_args)
-    for k, v in enumerate(api_inp):
-        if v['type'] == 'file':
-            del user_args[k+1]  # removes the next component
-
-    # Fill the params/files of the call
-    params, files = {}, {}
-    for k, v in enumerate(user_args):
-
-        inp_name = api_inp[k]['name']
-        inp_type = api_inp[k]['type']
+    params, files = plan(user_args)
+    return await planned_call(
+        params, files, plan=plan, gr_out=gr_out, url=url, mime=mime, schema=schema, cache=cache,
+        )
 
-        # If parameter is empty, don't send anything otherwise the call will fail
-        # Add condition for booleans, otherwise v=False wasn't being sent
-        if not v and not isinstance(v, bool):
-            continue
 
-        # If needed, preprocess Gradio inputs to deepaas-friendly format
-        if inp_type == 'integer':
-            v = int(v)
-        elif inp_type == 'array' and isinstance(v, str):
-            v = json.loads(f'[{v}]')
-
-        # Decide whether to add the arg to "params" or "files"
-        if inp_type == 'file':
-            # We try to provide the mimetype to the user whenever possible
-            mtype = mimetypes.guess_type(v)[0]
-            if mtype:
-                fname = Path(v).name
-                files[inp_name] = (fname, open(v, 'rb'), mtype)
-            else:
-                files[inp_name] = open(v, 'rb')
-        else:
-            params[inp_name] = v
+@recorded
+async def planned_call(params, files, plan, gr_out, url, mime, schema, cache):
+    """
+    Send a prediction to DEEPaaS, once the user args are mapped to its params
+    and files (see `api_call`).
+    """
 
     # We also send accept as a param in case the module does different post
     # processing based on this parameter.
@@ -285,76 +1989,345 @@ def api_call(
     headers = {'accept': mime}
     params['accept'] = mime
 
-    r = session.post(
-        url=url,
-        headers=headers,
-        params=params,
-        files=files,
-        )
+    # Return the cached prediction, if any
+    cache = cache and PREDICTION_CACHE
+    if cache:
+        key = await prediction_cache.key(url, mime, params, files)
+        rout = await prediction_cache.get(key)
+        if rout is not None:
+            return rout
+
+    # Items of batch inputs are coalesced with the ones of concurrent predictions.
+    # Media outputs are decoded straight to files, so those are not batched.
+    if (
+        plan.batch is not None and plan.batch.name in params and not files
+        and mime == 'application/json' and not media_labels(gr_out, schema)
+        ):
+        rc = await coalesced_call(params, plan=plan, gr_out=gr_out, url=url, mime=mime, schema=schema)
+        rout = format_outputs(rc, gr_out, schema)
+        if cache:
+            await prediction_cache.put(key, rout)
+        return rout
+
+    # Predictions wait for their turn to be sent to DEEPaaS.
+    # Files are streamed from disk instead of being loaded in memory.
+    # Likewise, non-JSON responses are streamed straight to disk.
+    # The time spent in each stage of the call is recorded in the metrics.
+    module = Path(urllib.parse.urlparse(url).path).parent.name
+    timings = metrics.StageTimer()
+    start = time.perf_counter()
+    tmpdir = None
+
+    # Each attempt (retries, hedges) times its own stages, and only the ones of
+    # the attempt whose response is used are kept
+    async def attempt():
+        timer = metrics.StageTimer()
+        status = 'error'
+        try:
+            queued = time.perf_counter()
+            async with admission.slot(), backends.route(url) as call:
+                timer.stages['queue'] = time.perf_counter() - queued
+                with MultipartStream(files) as body:
+                    sent = time.perf_counter()
+                    async with get_client().stream(
+                        'POST',
+                        url=call.url,
+                        headers={**headers, **body.headers} if files else headers,
+                        params=params,
+                        content=body if files else None,
+                        ) as r:
+
+                        status = str(r.status_code)
+                        call.failed = r.status_code in BACKEND_FAILURE_STATUSES  # passive health check of the replica
+                        uploaded = body.sent or sent
+                        timer.stages['upload'] = uploaded - sent
+                        timer.stages['inference'] = time.perf_counter() - uploaded
+
+                        with timer('download'):
+                            if r.status_code != 200:
+                                result = await read_response(r)
+                            elif mime == 'application/json':
+                                result = await spool_response(r)
+                            else:
+                                ftype = find_filetype(mime)
+                                result = await save_response(r, suffix=f".{ftype}", timings=timer)
+
+                    REQUEST_BYTES.inc(body.content_length if files else 0, module=module)
+                    RESPONSE_BYTES.inc(r.num_bytes_downloaded, module=module)
+        finally:
+            REQUESTS.inc(module=module, status=status)
+        return r, result, timer
+
+    try:
+        # Shrink the uploaded media, if requested in the input descriptions
+        with timings('preprocess'):
+            files, tmpdir = await preprocess_files(files, plan)
+
+        # Calls that fail before reaching the model are retried, and slow calls
+        # might be hedged with a duplicate one
+        r, result, timer = await resilient_call(attempt, url=url, module=module)
+        for stage, seconds in timer.stages.items():
+            timings.stages[stage] += seconds
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if r.status_code != 200:
+        raise Exception(result.decode("utf-8", errors="replace"))
 
     # Post processing of the output to Gradio-friendly format
     if mime == 'application/json':
-        rc = r.content.decode("utf-8")
 
+        # Media outputs are decoded from the response body straight to files
+        with result as spool, map_body(spool) as buf, timings('parse'):
+            rc = parse_json(
+                buf,
+                media=media_labels(gr_out, schema),
+                keys=output_keys(gr_out, schema),
+                timings=timings,
+                )
+        rout = format_outputs(rc, gr_out, schema)
+
+    else:
+        # Non-json responses have already been saved to file: return path
+        rout = result
+
+    if cache:
+        await prediction_cache.put(key, rout)
+
+    REQUEST_SECONDS.observe(time.perf_counter() - start, module=module)
+    for stage, seconds in timings.stages.items():
+        STAGE_SECONDS.observe(seconds, module=module, stage=stage)
+
+    return rout
+
+
+async def coalesced_call(params, plan, gr_out, url, mime, schema):
+    """
+    Send the items of the batch input of a prediction in the same DEEPaaS call
+    as the ones of concurrent predictions with the same params (see
+    `Coalescer`), and return the part of the output that belongs to them.
+    """
+    name = plan.batch.name
+    params = dict(params)
+    items = params.pop(name)
+    module = Path(urllib.parse.urlparse(url).path).parent.name
+    keys = output_keys(gr_out, schema)
+
+    async def send(items):
+
+        async def attempt():
+            status = 'error'
+            try:
+                async with admission.slot(), backends.route(url) as call:
+                    async with get_client().stream(
+                        'POST',
+                        url=call.url,
+                        headers={'accept': mime},
+                        params={**params, name: items},
+                        ) as r:
+                        status = str(r.status_code)
+                        call.failed = r.status_code in BACKEND_FAILURE_STATUSES  # passive health check of the replica
+                        if r.status_code != 200:
+                            result = await read_response(r)
+                        else:
+                            result = await spool_response(r)
+                    RESPONSE_BYTES.inc(r.num_bytes_downloaded, module=module)
+            finally:
+                REQUESTS.inc(module=module, status=status)
+            return r, result
+
+        start = time.perf_counter()
+        r, result = await resilient_call(attempt, url=url, module=module)
         if r.status_code != 200:
-            raise Exception(rc)
-
-        rc = json.loads(rc)
-
-        # This is probably not very general, only seems implemented in image-classification-tf
-        # (and related modules)  --> remove at some point
-        if rc.get('status', '') == 'error':
-            raise Exception(rc['message'])
-
-        # If schema is provided, reorder outputs in Gradio's expected order
-        # and format outputs (if needed)
-        if schema:
-            rout = []
-            for arg in gr_out:
-                label = arg.label
-
-                # Even if defined in schema, modules don't return the value.
-                # Swagger does not complain, nor shouldn't we
-                value = rc.get(label, None)
-
-                # Handle classification outputs
-                if label == 'classification scores':
-                    rout.append(
-                        dict(
-                            zip(
-                                rc['labels'],
-                                rc['probabilities']
-                                )
-                            )
-                        )
-
-                # Process media files
-                elif isinstance(arg, (gr.Image, gr.Audio, gr.Video)):
-                    media = value.encode('utf-8')  # bytes
-                    media = base64.b64decode(media)  # bytes
-                    with tempfile.NamedTemporaryFile(delete=False) as fp:
-                        fp.write(media)
-                    rout.append(fp.name)
-
-                # Make sure generic "webargs.Field" params are strings
-                elif isinstance(arg, gr.Textbox) and arg.type=='str':
-                    rout.append(str(value))
+            raise Exception(result.decode("utf-8", errors="replace"))
+        REQUEST_SECONDS.observe(time.perf_counter() - start, module=module)
+        with result as spool, map_body(spool) as buf:
+            return parse_json(buf, keys=keys)
+
+    key = (url, mime, json.dumps(params, sort_keys=True, default=str))
+    return await coalescer.submit(key, items, int(plan.batch.tags['batch']), send)
+
+
+async def stream_call(
+    *user_args: tuple,  # Gradio input args, introduced by user
+    plan: RequestPlan,  # mapping of the Gradio args to the DEEPaaS args
+    gr_out: list, # output args expected by DEEPaaS
+    url: str,  # DEEPaaS predict endpoint (relative to the DEEPaaS replicas, or absolute)
+    mime: str,  # MIME of the call
+    schema: bool,  # whether the module has defined a schema for output validation
+    progress=gr.Progress(),  # filled by Gradio
+    ):
+    """
+    Streaming version of `api_call`, for modules that answer with NDJSON (one
+    JSON object per line, eg. one per processed frame). Each line holds some
+    of the outputs, and optionally the `progress` of the prediction (0-1).
+    Outputs are yielded to Gradio as they arrive. If the prediction is
+    stopped, or the user leaves (noticed by Gradio at the next output), the
+    request to DEEPaaS is aborted.
+    """
+    params, files = plan(user_args)
+    headers = {'accept': mime}
+    params['accept'] = mime
+
+    module = Path(urllib.parse.urlparse(url).path).parent.name
+    media = media_labels(gr_out, schema)
+    keys = output_keys(gr_out, schema) | {'progress'} if schema else None
+    status = 'error'
+    start = time.perf_counter()
+    tmpdir = None
+    rc = {}  # latest value of each output
+    try:
+        files, tmpdir = await preprocess_files(files, plan)
+        async with admission.slot(), backends.route(url) as call:
+            with MultipartStream(files) as body:
+                if files:
+                    headers.update(body.headers)
+                async with get_client().stream(
+                    'POST',
+                    url=call.url,
+                    headers=headers,
+                    params=params,
+                    content=body if files else None,
+                    ) as r:
+
+                    status = str(r.status_code)
+                    call.failed = r.status_code in BACKEND_FAILURE_STATUSES  # passive health check of the replica
+                    if r.status_code != 200:
+                        content = await read_response(r)
+                        raise Exception(content.decode("utf-8", errors="replace"))
 
+                    # Leaving this block (eg. the generator is closed by
+                    # Gradio) closes the connection, which aborts the request
+                    async for line in iter_lines(r):
+                        part = parse_json(line, media=media, keys=keys)
+                        if 'progress' in part:
+                            progress(float(part.pop('progress')))
+                        rc.update(part)
+                        if part:
+                            yield format_outputs(rc, gr_out, schema, final=False) if schema or 'predictions' in rc else rc
+
+                    # The last outputs come with the full values of the truncated ones
+                    if schema:
+                        yield format_outputs(rc, gr_out, schema)
+
+                REQUEST_BYTES.inc(body.content_length if files else 0, module=module)
+                RESPONSE_BYTES.inc(r.num_bytes_downloaded, module=module)
+    finally:
+        REQUESTS.inc(module=module, status=status)
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    REQUEST_SECONDS.observe(time.perf_counter() - start, module=module)
+
+
+async def batch_call(
+    *user_args: tuple,  # Gradio input args, introduced by user
+    api_call: callable,  # api_call() with non-user parameters pre-filled
+    plan: RequestPlan,  # mapping of the Gradio args to the DEEPaaS args
+    gr_out,  # output args expected by DEEPaaS
+    ):
+    """
+    Run a prediction for each of the uploaded files (or files inside zips), with
+    the same parameters. A summary with the latest results is yielded as they
+    complete, and all of them are finally bundled in a zip file
+    (`results.jsonl` + output files).
+    """
+    # Files are uploaded in the (first) file input
+    slot = plan.file_slot
+    paths = user_args[slot] or []
+
+    records = []
+    errors = 0
+
+    def summary():
+        # Only the latest results are sent to the browser, to keep the
+        # updates small on big batches
+        return {
+            'done': len(records),
+            'total': len(inputs),
+            'errors': errors,
+            'latest': records[-BATCH_SHOWN:],
+            }
+
+    fp = output_store.tempfile(suffix='.zip')
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir, fp:
+
+            # Expand zip files, within limits (zip bombs)
+            inputs = []
+            size = 0
+            for path in paths:
+                if Path(path).suffix.lower() == '.zip' and zipfile.is_zipfile(path):
+                    with zipfile.ZipFile(path) as zf:
+                        for member in zf.infolist():
+                            if member.is_dir():
+                                continue
+                            size += member.file_size
+                            if len(inputs) >= BATCH_MAX_FILES or size > BATCH_MAX_BYTES:
+                                raise Exception(
+                                    f"Batches are limited to {BATCH_MAX_FILES} files "
+                                    f"and {BATCH_MAX_BYTES} uncompressed bytes"
+                                    )
+                            inputs.append(zf.extract(member, path=tmpdir))
                 else:
-                    rout.append(value)
+                    inputs.append(path)
+            if len(inputs) > BATCH_MAX_FILES:
+                raise Exception(f"Batches are limited to {BATCH_MAX_FILES} files")
 
-        else:
-            # If no schema provided return everything as a JSON
-            rout = rc['predictions']
+            # Fan out the predictions to a bounded pool of workers
+            semaphore = asyncio.Semaphore(BATCH_WORKERS)
 
-    else:
-        # Process non-json responses: save to file and return path
-        ftype = find_filetype(mime)
-        with tempfile.NamedTemporaryFile(suffix=f".{ftype}", delete=False) as fp:
-            fp.write(r.content)
-        rout = fp.name
+            async def predict(path):
+                args = list(user_args)
+                args[slot] = path
+                async with semaphore:
+                    try:
+                        return path, await api_call(*args), None
+                    except Exception as e:
+                        return path, None, str(e)
 
-    return rout
+            # Output files are added to the results zip as soon as each prediction
+            # completes, as they might be evicted from the output store before the
+            # end of the batch. They are replaced by their path inside the zip.
+            loop = asyncio.get_running_loop()
+            tasks = [asyncio.ensure_future(predict(path)) for path in inputs]
+            try:
+                with zipfile.ZipFile(fp, 'w') as zf:
+                    for task in asyncio.as_completed(tasks):
+                        path, rout, error = await task
+                        k = len(records)
+                        record = {'file': os.path.relpath(path, tmpdir) if path.startswith(tmpdir) else Path(path).name}
+                        if error is None:
+                            if isinstance(gr_out, list):
+                                output = dict(zip([arg.label for arg in gr_out], rout))
+                            else:
+                                output = {'output': rout}
+                            try:
+                                for label, value in output.items():
+                                    if isinstance(value, str) and Path(value).parent == output_store.path:
+                                        arcname = f"outputs/{k}-{label}{Path(value).suffix}"
+                                        await loop.run_in_executor(None, functools.partial(zf.write, value, arcname=arcname))
+                                        output[label] = arcname
+                                record['output'] = output if isinstance(gr_out, list) else output['output']
+                            except OSError as e:
+                                record['error'] = f"Output could not be saved: {e}"
+                        else:
+                            record['error'] = error
+                        errors += 'error' in record
+                        records.append(record)
+                        yield summary(), None
+
+                    zf.writestr('results.jsonl', ''.join(json.dumps(r, default=str) + '\n' for r in records))
+            finally:
+                for task in tasks:
+                    task.cancel()
+    except BaseException:
+        os.remove(fp.name)  # unfinished batch (eg. stopped by the user)
+        raise
+    output_store.add(fp.name)
+
+    yield summary(), fp.name
 
 
 def generate_header():
@@ -380,9 +2353,19 @@ def generate_header():
         return header
 
 
-def generate_footer(metadata):
+@functools.lru_cache(maxsize=None)
+def get_version():
+    """
+    Return the git (branch, commit) of the UI. They are read from the
+    `.ui_version` file baked in the Docker image if present, otherwise they are
+    retrieved from git (only once).
+    """
+    version_file = main_path / '.ui_version'
+    if version_file.exists():
+        git_branch, _, git_commit = version_file.read_text().strip().partition(' ')
+        if git_branch and git_commit:
+            return git_branch, git_commit
 
-    # Retrieve git info
     git_commit = subprocess.run(
         ['git', 'log', '-1', '--format=%H'],
         stdout=subprocess.PIPE,
@@ -396,6 +2379,13 @@ def generate_footer(metadata):
         cwd=main_path,
         ).stdout.strip()
     git_branch = git_branch.split('/')[-1]  # remove the "origin/" part
+    return git_branch, git_commit
+
+
+def generate_footer(metadata):
+
+    # Retrieve git info
+    git_branch, git_commit = get_version()
 
     version_text = f"deepaas_ui/{git_branch}@{git_commit[:5]}"
     version_link = f"https://github.com/ai4os/deepaas_ui/tree/{git_commit}"
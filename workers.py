@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Multi-worker serving mode.
+
+The UI is launched in several worker processes, each one listening on a local
+port, behind a proxy that listens on the UI port. Gradio keeps the state of a
+session (queue, events, progress) in the process that serves it, so all the
+requests of a session are routed to the same worker (sticky sessions), based
+on the session hash that Gradio sends in every queue-related request. Other
+requests (page, assets, uploads, files) are spread among the workers: uploads
+and outputs live in Gradio's cache folder, shared by all the workers.
+"""
+
+import asyncio
+import collections
+import itertools
+import json
+import os
+from pathlib import Path
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+import httpx
+import uvicorn
+
+import metrics
+import ui_utils
+
+
+WORKER_START_TIMEOUT = float(os.getenv('WORKER_START_TIMEOUT', 600))  # seconds to wait for a worker to be ready
+WORKER_CHECK_INTERVAL = float(os.getenv('WORKER_CHECK_INTERVAL', 5))  # seconds between checks of dead workers
+
+# Headers that only apply to a single connection, so they are not proxied
+HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'content-length',
+    }
+
+# Requests whose JSON body tells the session (or event) they belong to
+SESSION_BODY_PATHS = ['/queue/join', '/cancel', '/reset', '/component_server', '/run/', '/api/']
+
+# Requests whose response tells the event that later requests will refer to
+EVENT_PATHS = ['/queue/join', '/call/']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Worker:
+    """
+    UI worker process, launched with the same arguments as the main process.
+    """
+
+    def __init__(self, index, api_url):
+        self.index = index
+        self.api_url = api_url
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.process = None
+        self.restarts = 0
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [
+                sys.executable, '-u', str(Path(__file__).parent / 'launch.py'),
+                '--api_url', self.api_url,
+                '--ui_port', str(self.port),
+                ],
+            env={**os.environ, 'UI_WORKER': str(self.index)},
+            )
+
+    def wait(self, timeout):
+        """
+        Wait until the worker serves the UI.
+        """
+        start = time.monotonic()
+        while time.monotonic() - start < timeout:
+            if self.process.poll() is not None:
+                raise Exception(f"Worker {self.index} exited with code {self.process.returncode}")
+            try:
+                httpx.get(f'{self.url}/config', timeout=1).raise_for_status()
+                return
+            except httpx.HTTPError:
+                time.sleep(0.5)
+        raise Exception(f"Worker {self.index} was not ready after {timeout}s")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class Proxy:
+    """
+    Reverse proxy that routes the requests of each Gradio session to the same
+    worker.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.next = itertools.cycle(range(len(workers)))
+        self.events = collections.OrderedDict()  # {event_id: worker}, for REST API calls
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(ui_utils.CONNECT_TIMEOUT, read=None),  # event streams stay open
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=ui_utils.POOL_MAX_KEEPALIVE * len(workers),
+                ),
+            )
+
+    def sticky(self, key):
+        return self.workers[zlib.crc32(key.encode('utf-8')) % len(self.workers)]
+
+    def route(self, request, body):
+        """
+        Pick the worker of a request.
+        """
+        path = request.url.path
+        session = request.query_params.get('session_hash') or request.query_params.get('upload_id')
+        if path.startswith('/heartbeat/'):
+            session = path.rsplit('/', 1)[-1]
+        if session:
+            return self.sticky(session)
+
+        if path.startswith('/call/') and path.count('/') == 3:
+            worker = self.events.get(path.rsplit('/', 1)[-1])
+            if worker:
+                return worker
+
+        if body:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                if data.get('session_hash'):
+                    return self.sticky(data['session_hash'])
+                if data.get('event_id') in self.events:
+                    return self.events[data['event_id']]
+
+        return self.workers[next(self.next)]
+
+    def remember(self, event_id, worker):
+        self.events[event_id] = worker
+        while len(self.events) > 10000:
+            self.events.popitem(last=False)
+
+    async def forward(self, request: Request):
+        path = request.url.path
+
+        # Small JSON bodies are read to find their session, others (eg.
+        # uploads) are streamed to the worker
+        if request.method == 'POST' and any(path.startswith(p) for p in SESSION_BODY_PATHS):
+            body = await request.body()
+        else:
+            body = None
+        worker = self.route(request, body)
+
+        if body is None and 'content-length' not in request.headers and 'transfer-encoding' not in request.headers:
+            body = b''
+        headers = [
+            (k, v) for k, v in request.headers.items()
+            if k.lower() not in HOP_HEADERS or (k.lower() == 'content-length' and body is None)
+            ]
+        url = worker.url + request.scope['raw_path'].decode('latin-1')
+        if request.url.query:
+            url += f'?{request.url.query}'
+        try:
+            r = await self.client.send(
+                self.client.build_request(
+                    request.method,
+                    url,
+                    headers=headers,
+                    content=body if body is not None else request.stream(),
+                    ),
+                stream=True,
+                )
+        except httpx.TransportError:
+            return PlainTextResponse(f'Worker {worker.index} is not available', status_code=502)
+
+        headers = {k: v for k, v in r.headers.items() if k.lower() not in HOP_HEADERS}
+
+        # Later requests of REST API calls refer to the event, not to the session
+        if request.method == 'POST' and any(path.startswith(p) for p in EVENT_PATHS):
+            try:
+                content = await r.aread()
+            finally:
+                await r.aclose()
+            try:
+                self.remember(json.loads(content)['event_id'], worker)
+            except (ValueError, KeyError, TypeError):
+                pass
+            return Response(content, status_code=r.status_code, headers=headers)
+
+        async def stream():
+            try:
+                async for chunk in r.aiter_raw():
+                    yield chunk
+            finally:
+                await r.aclose()
+
+        return StreamingResponse(stream(), status_code=r.status_code, headers=headers)
+
+    async def metrics(self):
+        """
+        Metrics of all the workers, told apart by a `worker` label.
+        """
+        async def fetch(worker):
+            try:
+                r = await self.client.get(f'{worker.url}/metrics', timeout=ui_utils.CONNECT_TIMEOUT)
+                return r.text if r.status_code == 200 else ''
+            except httpx.HTTPError:
+                return ''
+
+        texts = await asyncio.gather(*[fetch(worker) for worker in self.workers])
+        return PlainTextResponse(
+            metrics.merge(texts, label='worker'),
+            media_type='text/plain; version=0.0.4',
+            )
+
+
+def supervise(workers):
+    """
+    Restart the workers that died.
+    """
+    while True:
+        time.sleep(WORKER_CHECK_INTERVAL)
+        for worker in workers:
+            if worker.process.poll() is not None:
+                print(f"Worker {worker.index} exited with code {worker.process.returncode}, restarting it")
+                worker.restarts += 1
+                worker.start()
+
+
+def serve(api_url, ui_port, n):
+    """
+    Launch `n` UI workers and serve them behind a sticky proxy on `ui_port`.
+    """
+    start = time.perf_counter()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))  # stop the workers on exit
+    workers = [Worker(k, api_url) for k in range(n)]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.wait(WORKER_START_TIMEOUT)
+        print(f"{n} UI workers ready in {time.perf_counter() - start:.2f}s")
+
+        threading.Thread(target=supervise, args=(workers,), daemon=True).start()
+
+        proxy = Proxy(workers)
+        app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
+        app.add_api_route('/metrics', proxy.metrics, methods=['GET'])
+        app.add_api_route(
+            '/{path:path}',
+            proxy.forward,
+            methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'],
+            )
+        uvicorn.run(app, host='0.0.0.0', port=ui_port, log_level='warning')
+    finally:
+        for worker in workers:
+            worker.stop()